@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from argparse import ArgumentParser
-from os import path, makedirs, getpid
+from os import path, makedirs, getpid, replace
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -11,19 +11,36 @@ from tqdm import tqdm, trange
 
 from thesis import plot
 from thesis.data.musdb import MusDBSamples
-from thesis.data.toy import ToyData, generate_toy
-from thesis.io import load_model, save_append, get_newest_checkpoint, appendz, \
-    log_call
+from thesis.data.toy import ToyData, generate_toy_batch
+from thesis.io import load_model, get_newest_checkpoint, log_call
+from thesis.results import ResultStore
 from thesis.setup import DEFAULT
 from thesis.nn.models.flowavenet import FlowavenetClassified, Flowavenet
 
 mpl.use("agg")
 
 
+@torch.no_grad()
+def score(model, x):
+    """
+    Mean log p per channel of the samples. Uses the logging free
+    `log_prob` where the model has one.
+    """
+    if hasattr(model, "log_prob"):
+        return model.log_prob(x)[0]
+    return model(x, _ce=False)[1].mean(-1)
+
+
 @log_call(1)
 def make_sample_from_prior(args, model=None):
+    from thesis.nn.models.wavenet import WaveNet
+
     if model is None:
         model = load_model(args.weights, args.device)
+    if isinstance(model, WaveNet):
+        x = model.sample(1, 2_000)
+        ResultStore(args.results_file).append(samples=x.cpu().numpy().squeeze())
+        return
     length = 8_000 if not args.musdb else 16_384
     zshape = (1, 4, length)
     z = torch.randn(zshape, device=args.device)
@@ -35,12 +52,12 @@ def make_sample_from_prior(args, model=None):
         z_, *_ = model(data[0][None, ...].to(args.device), _ce=False)
         z[:, 2, ...] = z_[:, 2, ...] + 0.4*torch.randn((1, 1, length), device=args.device)
 
-    x = model.reverse(z)
+    x = model.sample(1, length, z=z, verbose=True)
     x = x[0, :, 3000:5000]
     x = x.clamp(-1.5, 1.5)
     x = x.cpu().numpy().squeeze()
 
-    appendz(args.results_file, samples=[x])
+    ResultStore(args.results_file).append(samples=x)
 
 
 @log_call(1)
@@ -53,10 +70,10 @@ def make_const_logp(args, model=None):
 
     for i, level in enumerate(tqdm(const_levels, leave=False)):
         x = level * torch.ones((1, 4, length), device=args.device)
-        log_p = model(x, _ce=False)[1][0, ...].mean(-1)
+        log_p = score(model, x)[0, ...]
         results[i] = log_p.cpu().squeeze().numpy()
 
-    appendz(args.results_file, const_levels=const_levels, const_logp=results)
+    ResultStore(args.results_file).append(const_levels=const_levels, const_logp=results)
 
 
 @log_call(1)
@@ -69,10 +86,10 @@ def make_noise_logp(args, model=None):
 
     for i, level in enumerate(noise_levels):
         x = level * torch.randn((1, 4, length), device=args.device)
-        log_p = model(x, _ce=False)[1][0, ...].mean(-1)
+        log_p = score(model, x)[0, ...]
         results[i] = log_p.cpu().squeeze().numpy()
 
-    appendz(args.results_file, noise_levels=noise_levels, noise_logp=results)
+    ResultStore(args.results_file).append(noise_levels=noise_levels, noise_logp=results)
 
 
 @log_call(1)
@@ -92,10 +109,10 @@ def make_rel_noised_logp(args, model=None):
     for j, σ in enumerate(tqdm(noise_levels, leave=False)):
         for i, s in enumerate(tqdm(data, leave=False)):
             s = (s + σ * torch.randn_like(s)).to(args.device)
-            log_p = model(s, _ce=False)[1].mean(-1)
+            log_p = score(model, s)
             results[j, :, i * N : (i + 1) * N] = log_p.T.cpu().numpy()
 
-    appendz(args.results_file, noised=results)
+    ResultStore(args.results_file).append(noised=results)
 
 
 @log_call(1)
@@ -119,11 +136,11 @@ def make_rel_source_logp(args, model=None):
     for i, s in enumerate(tqdm(data, leave=False)):
         *_, L = s.shape
         s = s.view(N * 4, 1, L).repeat(1, 4, 1).to(args.device)
-        log_p = model(s, _ce=False)[1].mean(-1)
+        log_p = score(model, s)
         results[:, :, (i * N) : ((i + 1) * N)] = (
             log_p.view(N, 4, 4).permute(1, 2, 0).squeeze().cpu().numpy()
         )
-    appendz(args.results_file, channels=results)
+    ResultStore(args.results_file).append(channels=results)
 
 
 def make_separation_examples(args):
@@ -137,55 +154,150 @@ def make_separation_examples(args):
         plt.close()
 
 
+def make_separate_track(args):
+    import soundfile
+    from time import time
+    from thesis.audio import read_blocks, resample_stream, OverlapAdd
+    from thesis.nn.modules import MelSpectrogram
+
+    sr, window, batch = 14_700, args.window, args.batch_size
+    hop = window // 2
+
+    model = load_model(args.weights, args.device)
+    q_sǀm, n_classes = model.q_sǀm, model.q_sǀm.n_classes
+    n_mels = q_sǀm.f.res_blocks[0].cin_channels
+    mel = MelSpectrogram(n_mels=n_mels, sr=sr).to(args.device)
+    start_time = time()
+
+    # The training signals are normalized, so first get mean and peak
+    lo, hi, total, n = np.inf, -np.inf, 0.0, 0
+    for block in read_blocks(args.track):
+        lo, hi = min(lo, block.min()), max(hi, block.max())
+        total, n = total + block.sum(dtype=np.float64), n + block.shape[-1]
+    mean = total / n
+    peak = max(hi - mean, mean - lo, 1e-8)
+
+    name = path.splitext(path.basename(args.track))[0]
+    makedirs(f"./figures/{args.basename}", exist_ok=True)
+    stems = [
+        soundfile.SoundFile(
+            f"./figures/{args.basename}/{name}_{signal}.wav", "w", sr, 1, "FLOAT"
+        )
+        for signal in DEFAULT.signals[:n_classes]
+    ]
+    ola = OverlapAdd(n_classes, window)
+    buffer, offset, position = np.zeros(0, dtype=np.float32), 0, 0
+
+    def separate(positions):
+        frames = np.stack([buffer[p - offset : p - offset + window] for p in positions])
+        m = torch.from_numpy(frames).to(args.device)
+        q_s = q_sǀm(m[:, None, :].repeat(1, n_classes, 1), mel(m))
+        for p, frame in zip(positions, q_s.mean.cpu().numpy()):
+            ola.add(p, frame)
+
+    def write(until):
+        for stem, signal in zip(stems, ola.pop(until) * peak):
+            stem.write(signal)
+
+    blocks = resample_stream(read_blocks(args.track), soundfile.info(args.track).samplerate, sr)
+    for block in blocks:
+        buffer = np.concatenate((buffer, ((block - mean) / peak).astype(np.float32)))
+        while offset + buffer.shape[-1] >= position + (batch - 1) * hop + window:
+            separate([position + i * hop for i in range(batch)])
+            position += batch * hop
+            write(position)
+            buffer, offset = buffer[position - offset :], position
+
+    # The last windows run over the end of the track, pad them with silence
+    length = offset + buffer.shape[-1]
+    buffer = np.pad(buffer, (0, batch * hop + window))
+    positions = list(range(position, length, hop))
+    for i in range(0, len(positions), batch):
+        separate(positions[i : i + batch])
+    write(length)
+    for stem in stems:
+        stem.close()
+
+    duration = length / sr
+    rtf = (time() - start_time) / duration
+    print(f"Separated {duration:.1f}s of {name} into ./figures/{args.basename}/")
+    print(f"Real-time factor {Fore.GREEN}{rtf:.3f}{Fore.RESET}")
+
+
 def make_posterior_examples(args):
     model = load_model(args.weights, args.device)
     dset = ToyData(args.data, "test", mix=True, mel=True, source=True)
 
+    results = ResultStore(f"./figures/{args.basename}/mean_posterior")
     for (m, mel), s in tqdm(dset):
         (ŝ,) = model.q_s(m.unsqueeze(0), mel.unsqueeze(0)).mean
         ŝ_mel = torch.cat([model.mel(ŝ[k, :])[None, :] for k in range(4)], dim=0)
-        save_append(
-            f"./figures/{args.basename}/mean_posterior.pt", (ŝ.unsqueeze(1), ŝ_mel)
-        )
+        results.append(s=ŝ.unsqueeze(1).cpu().numpy(), mel=ŝ_mel.cpu().numpy())
 
 
 def make_toy_dataset(args):
-    length, ns = 48_000, 4
+    from thesis.data.store import PackWriter
+
+    length, ns, chunk = 48_000, 4, 100
     config = {"test": 1_500, "train": 5_000}
 
     for name, n in config.items():
         print(f"Generate Toy [{name}] n={n}, length={length}, ns={ns}")
-        print(f"Save to {args.data}/{name}")
-        makedirs(f"{args.data}/{name}/", exist_ok=True)
-        for i in trange(n):
-            item = generate_toy(length, ns)
-            np.save(f"{args.data}/{name}/{name}_{i:05}.npy", item)
+        print(f"Save to {args.data}/{name}.pack")
+        makedirs(args.data, exist_ok=True)
+        with PackWriter(f"{args.data}/{name}.pack.tmp", length=length, ns=ns) as pack:
+            sources = pack.reserve("sources", (n, ns, length))
+            mix = pack.reserve("mix", (n, length))
+            ν = pack.reserve("ν", (n, ns), np.int64)
+            φ = pack.reserve("φ", (n, ns), np.int64)
+            for i in trange(0, n, chunk):
+                batch = generate_toy_batch(min(chunk, n - i), length, ns)
+                sources[i : i + chunk] = batch["sources"]
+                mix[i : i + chunk] = batch["mix"]
+                ν[i : i + chunk], φ[i : i + chunk] = batch["ν"], batch["φ"]
+            pack.meta["shape"] = batch["shape"]
+        replace(f"{args.data}/{name}.pack.tmp", f"{args.data}/{name}.pack")
 
 
 def make_musdb_dataset(args):
     from thesis.data.musdb import MusDB
+    from thesis.data.store import ShardWriter
 
     length, n = 48_000, 150
 
     for subset in ["test", "train"]:
-        data = MusDB(args.data, subsets=subset, mel=True)
+        data = MusDB(args.data, subsets=subset, mel=True, cached=None)
         fp = path.normpath(data.path) + "_samples/" + subset
         makedirs(fp, exist_ok=True)
         pid = getpid()
-        for i, (wav, mel) in enumerate(
-            tqdm(data.pre_save(n_per_song=n, length=length), total=len(data) * n)
-        ):
-            np.save(f"{fp}/{i // n:03}_{i % n:03}_{pid}_mel.npy", mel.numpy())
-            np.save(f"{fp}/{i // n:03}_{i % n:03}_{pid}_time.npy", wav.numpy())
+        with ShardWriter(f"{fp}/mel_{pid}") as mel_shards, ShardWriter(
+            f"{fp}/time_{pid}"
+        ) as time_shards:
+            for wav, mel in tqdm(
+                data.pre_save(n_per_song=n, length=length), total=len(data) * n
+            ):
+                mel_shards.append(mel.numpy())
+                time_shards.append(wav.numpy())
+
+
+def make_musdb_cache(args):
+    from thesis.data.musdb import MusDB
+
+    for subset in ["test", "train"]:
+        data = MusDB(args.data, subsets=subset)
+        print(f"Cache MusDB [{subset}] n={len(data)}")
+        print(f"Save to {data.cache_path}")
+        data.build_cache()
 
 
 def make_langevin(args):
-    from thesis.langevin import langevin_sample
+    from thesis.langevin import LangevinSampler
 
-    noise, length = 0.0, 16_384 // 4
+    noise, length, chains = 0.0, 16_384 // 4, 4
 
     model = load_model(args.weights, args.device)
     σ = 0.1
+    sampler = LangevinSampler(model, [σ], steps=300, η=3e-5 * (σ / 0.01) ** 2, thin=10)
 
     opt = (
         {"source": True, "mix": True}
@@ -200,17 +312,160 @@ def make_langevin(args):
         fig = plot.toy.reconstruction(s, sharey=True, ylim=[-1, 1])
         plt.savefig(f"s_{i:03}.png")
         plt.close(fig)
-        for j, (ŝ, ℒ, δŝ) in enumerate(
-            langevin_sample(model, σ, m.to(args.device), ŝ=s.clone().to(args.device))
-        ):
-            print(ℒ)
-            δŝ /= δŝ.abs().max()
-            fig = plot.toy.reconstruction(s, ŝ, δŝ, sharey=True, ylim=[-1, 1])
-            plt.suptitle(ℒ)
+        ŝ = (s + 0.3 * torch.randn_like(s)).to(args.device)
+        _, log, trace = sampler.sample(m.to(args.device), ŝ=ŝ, chains=chains)
+        for it, _, log_p in log:
+            print(f"step {it:>4} log p={', '.join(f'{x:.3}' for x in log_p[0].tolist())}")
+        for j, ŝ in enumerate(trace[:, :, 0]):
+            fig = plot.toy.reconstruction(s, ŝ, sharey=True, ylim=[-1, 1])
+            plt.suptitle(f"step {j * sampler.thin}")
             plt.savefig(f"ŝ_{i:03}_{j:04}.png")
             plt.close(fig)
 
 
+def make_data_benchmark(args):
+    """
+    Benchmarks the loaders of the toy data at --data, or with -musdb of the
+    MusDB samples and tracks.
+    """
+    from itertools import product
+    from thesis.bench import bench_loader, write_results
+    from thesis.data.musdb import MusDB
+
+    batch_sizes, workers, lengths, mels = [8, 32], [0, 4, 8], [4_096, 16_384], [False, True]
+    n_batches = 30
+
+    def toy(length, mel):
+        d = ToyData(args.data, "test", source=True, mel_source=mel, length=length)
+        return d, "pack" if d.pack is not None else "npy"
+
+    def samples(length, mel):
+        # Mel windows of the samples are counted in frames
+        length = MusDBSamples.mel_frames(length) if (mel and length) else length
+        d = MusDBSamples(args.data, "test", space="mel" if mel else "time", length=length)
+        return d, "shards" if d.shards is not None else "npy"
+
+    def tracks(length, mel):
+        d = MusDB(args.data, "test", cached=None)
+        return d, "cache" if d.pack is not None else "decode"
+
+    if args.musdb:
+        datasets = {"MusDBSamples": samples, "MusDB": tracks}
+    else:
+        datasets = {"ToyData": toy}
+
+    records = []
+    for name, dataset in datasets.items():
+        # Full MusDB tracks differ in length, so only single-track batches
+        if name == "MusDB":
+            variants, loaders = [(False, True)], list(product([1], workers))
+        else:
+            variants, loaders = list(product(lengths, mels)), list(product(batch_sizes, workers))
+        for length, mel in variants:
+            try:
+                data, storage = dataset(length, mel)
+                if len(data) == 0:
+                    raise FileNotFoundError("no samples found")
+            except Exception as e:
+                print(f"{Fore.RED}Skip {name} (L={length}, mel={mel}): {e}{Fore.RESET}")
+                continue
+            for batch_size, n_workers in loaders:
+                try:
+                    loader = data.loader(batch_size, num_workers=n_workers)
+                    result = bench_loader(loader, n_batches if name != "MusDB" else 3)
+                except Exception as e:
+                    print(
+                        f"{Fore.RED}Skip {name} bs={batch_size} workers={n_workers} "
+                        f"(L={length}, mel={mel}): {e}{Fore.RESET}"
+                    )
+                    continue
+                records.append(
+                    dict(
+                        dataset=name, storage=storage, batch_size=batch_size,
+                        workers=n_workers, length=length, mel=mel, **result
+                    )
+                )
+                print(
+                    f"{name:>12} {storage:>6} bs={batch_size:<3} workers={n_workers} "
+                    f"L={length} mel={mel:d}"
+                    f"\t{Fore.GREEN}{result['samples/s']:8.1f}{Fore.RESET} samples/s"
+                    f"\tp50={result['p50'] * 1e3:.1f}ms p99={result['p99'] * 1e3:.1f}ms"
+                    f"\tworkers={result['rss_workers'] / 2 ** 20:.0f}MiB"
+                )
+    write_results(args.results_file, records)
+    print(f"Written to {args.results_file}")
+
+
+def make_permute_benchmark(args):
+    from thesis.bench import bench_permute, write_results
+
+    records = []
+    for groups in [1, 4]:
+        # Shapes of the flows in the first and the last block of the priors
+        for N, C, L in [(8, 8, 8_192), (8, 32, 2_048), (32, 8, 8_192)]:
+            x = torch.randn(N, C * groups, L, device=args.device)
+            result = bench_permute(x, groups)
+            print(
+                f"groups={groups} {N}×{C * groups}×{L}\t"
+                f"{result['bytes/before'] / 2 ** 20:7.1f}MiB → "
+                f"{Fore.GREEN}{result['bytes/after'] / 2 ** 20:7.1f}MiB{Fore.RESET}\t"
+                f"{result['time/before'] * 1e3:6.2f}ms → "
+                f"{Fore.GREEN}{result['time/after'] * 1e3:6.2f}ms{Fore.RESET}"
+            )
+            records.append(dict(groups=groups, shape=[N, C * groups, L], **result))
+    write_results(args.results_file, records)
+    print(f"Written to {args.results_file}")
+
+
+def make_flow_benchmark(args):
+    from thesis.bench import timed, write_results
+    from thesis.nn.models.glow import Glow
+
+    N, L, H = args.batch_size, 2 ** 12, 16
+    records = []
+    for name, n_block, n_flow, width in [
+        ("flowavenet", 4, 2, 32),
+        ("flowavenet", 8, 4, 32),
+        ("flowavenet", 4, 2, 128),
+        ("glow", 2, 4, 64),
+        ("glow", 3, 8, 64),
+        ("glow", 2, 4, 256),
+    ]:
+        if name == "flowavenet":
+            model = Flowavenet(
+                in_channel=1, n_block=n_block, n_flow=n_flow, n_layer=4,
+                width=width, block_per_split=4, groups=4,
+            )
+            x = torch.rand(N, 4, L, device=args.device) * 2 - 1
+        else:
+            model = Glow(4, n_flow, n_block, groups=4, width=width)
+            x = torch.rand(N, 4, H, L // 64, device=args.device)
+        model = model.to(args.device)
+        model(x)  # initializes the act norms
+        model.eval()
+
+        score = model.log_prob if name == "flowavenet" else model.forward
+        kwargs = dict(height=H) if name == "glow" else {}
+        device = torch.device(args.device)
+        t_fwd = timed(lambda: score(x), device, n=5)
+        t_rev = timed(
+            lambda: model.sample(N, x.shape[-1], **kwargs), device, n=5
+        )
+        print(
+            f"{name} blocks={n_block} flows={n_flow} width={width}\t"
+            f"log p {Fore.GREEN}{N / t_fwd:8.1f}{Fore.RESET} samples/s\t"
+            f"sample {Fore.GREEN}{N / t_rev:8.1f}{Fore.RESET} samples/s"
+        )
+        records.append(
+            dict(
+                model=name, n_block=n_block, n_flow=n_flow, width=width,
+                shape=list(x.shape), forward=N / t_fwd, reverse=N / t_rev,
+            )
+        )
+    write_results(args.results_file, records)
+    print(f"Written to {args.results_file}")
+
+
 def evaluate_prior(args):
     from thesis.nn.models.wavenet import WaveNet
     model_class = FlowavenetClassified if "Classified" in args.weights else Flowavenet
@@ -230,9 +485,13 @@ def main(args):
 
     if args.weights is not None:
         args.basename = path.basename(args.weights)[:-10]
-        args.results_file = f"./figures/{args.basename}.npz"
+        # Every run appends one row per key, e.g. const_logp is [runs × 31 × 4].
+        # The former .npz files were concatenated instead, [runs·31 × 4].
+        args.results_file = f"./figures/{args.basename}.results"
+    elif args.command.startswith("bench"):
+        args.results_file = f"./figures/{args.command}.jsonl"
 
-    if args.command == "musdb":
+    if args.command.startswith("musdb"):
         args.musdb = True
 
     DEFAULT.musdb = args.musdb
@@ -246,16 +505,22 @@ def main(args):
 
 
 COMMANDS = {
+    "sample": make_sample_from_prior,
     "channels": make_rel_source_logp,
     "separate": make_separation_examples,
+    "separate-track": make_separate_track,
     "noised": make_rel_noised_logp,
     "posterior": make_posterior_examples,
     "toy": make_toy_dataset,
     "musdb": make_musdb_dataset,
+    "musdb-cache": make_musdb_cache,
     "langevin": make_langevin,
     "eval": evaluate_prior,
     "noise": make_noise_logp,
     "const": make_const_logp,
+    "bench-data": make_data_benchmark,
+    "bench-permute": make_permute_benchmark,
+    "bench-flows": make_flow_benchmark,
 }
 
 if __name__ == "__main__":
@@ -264,6 +529,9 @@ if __name__ == "__main__":
     parser.add_argument("--weights", type=get_newest_checkpoint)
     parser.add_argument("-k", type=str)
     parser.add_argument("--data", type=path.abspath, default=None)
+    parser.add_argument("--track", type=path.abspath, help="audio file to separate")
+    parser.add_argument("--window", type=int, default=2 ** 14)
+    parser.add_argument("--batch_size", type=int, default=4)
     parser.add_argument("-cpu", action="store_true")
     parser.add_argument("-musdb", action="store_true")
     main(parser.parse_args())
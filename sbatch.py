@@ -37,6 +37,11 @@ def main(args):
     }
     if not args.cpu:
         c["gres"] = f"gpu:{args.ngpu}"
+    # One task per GPU, every task trains as one process of the group
+    distributed = args.file == "train" and args.nodes * args.ngpu > 1
+    if distributed:
+        c["nodes"] = args.nodes
+        c["ntasks-per-node"] = 1 if args.cpu else args.ngpu
 
     f = f"#!/usr/bin/env bash\n\n"
     f += "\n".join(f"#SBATCH --{k}={v}" for k, v in c.items()) + "\n"
@@ -48,6 +53,11 @@ def main(args):
         'export LANG="$LC_ALL"\n\n'
     )
     f += "cd /home/frankm/thesis\n"
+    if distributed:
+        f += (
+            'export MASTER_ADDR="$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)"\n'
+            "export MASTER_PORT=29500\n"
+        )
 
     f += (
         f"srun /home/frankm/.pyenv/shims/python3.7 {args.file}.py " f"{args.experiment}"
@@ -99,5 +109,6 @@ if __name__ == "__main__":
     parser.add_argument("-lr")
     parser.add_argument("-cpu", action="store_true")
     parser.add_argument("-ngpu", default=1, type=int)
+    parser.add_argument("-nodes", default=1, type=int)
     parser.add_argument("-noise")
     main(parser.parse_args())
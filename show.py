@@ -16,13 +16,15 @@ from thesis import plot
 from thesis.data.toy import ToyData
 from thesis.io import load_model, exit_prompt, get_newest_checkpoint, get_newest_file
 from thesis.nn.modules import MelSpectrogram
+from thesis.results import ResultStore
 from thesis.setup import TOY_SIGNALS, DEFAULT_TOY, MUSDB_SIGNALS
 
 mpl.use("TkCairo")
 
 
 def show_sample(args):
-    model = load_model(args.weights, args.device)
+    # Not from the cache, p_s is set on it
+    model = load_model(args.weights, args.device, cache=False)
     model.p_s = [
         load_model(get_newest_checkpoint("*Discr*"), args.device).to(args.device)
     ]
@@ -41,7 +43,8 @@ def show_sample(args):
 
 def show_sample_denoiser(args):
     k = TOY_SIGNALS.index(args.k)
-    model = load_model(args.weights, args.device)
+    # Not from the cache, p_s is set on it
+    model = load_model(args.weights, args.device, cache=False)
     model.p_s = [
         load_model(get_newest_checkpoint(f"Apr04*{args.k}*pt"), args.device).to(
             args.device
@@ -173,9 +176,10 @@ def show_posterior(args):
     model = load_model(args.weights, args.device)
     mel_spectr = MelSpectrogram()
 
-    data = torch.load(f"./figures/{args.basename}/mean_posterior.pt")
+    results = ResultStore(f"./figures/{args.basename}/mean_posterior")
 
-    for s, _ in data:
+    for s in results["s"]:
+        s = torch.from_numpy(s)
         s_max = s.detach().squeeze().abs().max(dim=1).values[:, None, None]
         s = s / s_max
         s_mel = mel_spectr(s)
@@ -254,7 +258,7 @@ def show_interpolate_prior(args):
         β, *_ = model.forward(b)
         γ = (α + β) / 2
 
-        c = model.reverse(γ)
+        c = model.sample(len(γ), γ.shape[-1], z=γ, verbose=True)
         np.save(
             "../thesis-tex/data/prior_toy_interpolate.npy", torch.cat((a, b, c)).numpy()
         )
@@ -1,6 +1,6 @@
-from math import log
+from math import ceil, gcd, log
 from math import pi as π
-from typing import Tuple
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from numpy.random import randint
@@ -42,6 +42,61 @@ def oscillator(length: int, shape: str, ν: int, φ: int = 0) -> np.ndarray:
     return y
 
 
+def oscillators(
+    length: int,
+    shapes: Union[str, Sequence],
+    ν: np.ndarray,
+    φ: np.ndarray,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Vectorized version of `oscillator` that synthesizes a whole block of
+    waveforms in one pass. The phase is computed with integer arithmetic, so
+    unlike `oscillator` samples exactly on a period boundary never flip.
+
+    Args:
+        length: The length of the signals
+        shapes: The curve for every waveform, broadcastable to [N×C]
+        ν: The lengths of one period [N×C]
+        φ: The phases in [0, ν] [N×C]
+        rng: random generator for the noise shape
+
+    Returns:
+        the waveforms [N×C×length]
+    """
+    ν, φ = np.asarray(ν, dtype=np.int64), np.asarray(φ, dtype=np.int64)
+    assert np.all(0 <= φ) and np.all(φ <= ν)
+    shapes = np.broadcast_to(np.char.lower(np.asarray(shapes, dtype=str)), ν.shape)
+
+    # Position inside the period for every sample
+    j = (np.arange(length) + φ[..., None]) % ν[..., None]
+    y = np.empty(j.shape, dtype=np.float32)
+    for shape in np.unique(shapes):
+        mask = shapes == shape
+        _j, _ν = j[mask], ν[mask][:, None]
+        p = _j / _ν
+        if shape == "triangle":
+            _y = np.where(p < 0.5, 4 * p - 1, 3 - 4 * p)
+        elif shape == "saw":
+            _y = 2 * p - 1
+        elif shape == "reversesaw":
+            _y = 1 - 2 * p
+        elif shape == "square":
+            _y = np.where(p < 0.5, 1.0, -1.0)
+        elif shape == "halfsin":
+            half = _ν // 2
+            _y = np.where(_j < half, np.sin(2 * π * _j / np.maximum(half - 1, 1)), 0.0)
+        elif shape == "noise":
+            rng = np.random.default_rng(randint(2 ** 32)) if rng is None else rng
+            _y = 0.1 * rng.random(_j.shape)
+        elif shape == "sin":
+            _y = np.sin(2 * π * p)
+        else:
+            raise ValueError("Invalid shape given")
+        y[mask] = _y
+    return y
+
+
 def key2freq(n: int) -> float:
     """
     Gives the frequency for a given piano key.
@@ -62,6 +117,34 @@ def rand_period_phase(high: int = 88, low: int = 1, sr: int = 14_700) -> Tuple[i
     return ν, φ
 
 
+def rand_periods_phases(
+    size,
+    high: int = 88,
+    low: int = 1,
+    sr: int = 14_700,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized version of `rand_period_phase`.
+
+    Args:
+        size: output shape
+        high: highest piano key
+        low: lowest piano key
+        sr: sample rate
+        rng: random generator, defaults to one seeded from the global state
+
+    Returns:
+        periods ν and phases φ, both integer arrays of the given size
+    """
+    rng = np.random.default_rng(randint(2 ** 32)) if rng is None else rng
+    key = rng.integers(low, high * 10, size) / 10
+    freq = key2freq(key)
+    ν = (sr // freq).astype(np.int64)
+    φ = (rng.random(size) * ν).astype(np.int64)
+    return ν, φ
+
+
 def mel_spectrogram(waveform):
     from .nn.modules import MelSpectrogram
 
@@ -106,3 +189,100 @@ def decode_μ_law(waveform: torch.Tensor, μ: int = 255) -> torch.Tensor:
     out = (waveform.type(torch.float32) - hμ) / hμ
     out = torch.sign(out) / μ * (torch.pow(μ, torch.abs(out)) - 1)
     return out
+
+
+def read_blocks(fp: str, block: int = 2 ** 18) -> Iterator[np.ndarray]:
+    """
+    Reads an audio file lazily in blocks, down-mixed to mono.
+
+    Args:
+        fp: path to the audio file
+        block: number of frames per block
+
+    Returns:
+        generator of the blocks [block]
+    """
+    import soundfile
+
+    for frames in soundfile.blocks(fp, blocksize=block, dtype="float32", always_2d=True):
+        yield frames.mean(-1)
+
+
+def resample_stream(
+    blocks: Iterable[np.ndarray], sr: int, new_sr: int
+) -> Iterator[np.ndarray]:
+    """
+    Polyphase resampling of a signal given in consecutive blocks [… × n], the
+    same as resampling the whole signal with `signal.resample_poly`. Every
+    block is resampled with enough of its neighbours that the filter never
+    sees a block edge.
+
+    Args:
+        blocks: the blocks of the signal
+        sr: sampling rate of the signal
+        new_sr: the new sampling rate
+
+    Returns:
+        generator of the resampled blocks
+    """
+    up, down = new_sr // gcd(sr, new_sr), sr // gcd(sr, new_sr)
+    # Half the filter of resample_poly in input samples, as multiple of down
+    pad = down * ceil((10 * max(up, down) / up + 1) / down)
+
+    buffer, start, pos = None, 0, 0
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate((buffer, block), -1)
+        n = (start + buffer.shape[-1] - pad - pos) // down * down
+        if n <= 0:
+            continue
+        a = max(pos - pad, 0)
+        y = signal.resample_poly(buffer[..., a - start : pos + n + pad - start], up, down, axis=-1)
+        skip = (pos - a) * up // down
+        yield y[..., skip : skip + n * up // down]
+        pos += n
+        buffer, start = buffer[..., max(pos - pad, 0) - start :], max(pos - pad, 0)
+
+    if buffer is not None and pos < start + buffer.shape[-1]:
+        a = max(pos - pad, 0)
+        y = signal.resample_poly(buffer[..., a - start :], up, down, axis=-1)
+        yield y[..., (pos - a) * up // down :]
+
+
+class OverlapAdd(object):
+    def __init__(self, channels: int, window: int):
+        """
+        Overlap-adds windowed frames into a signal and gives out every part of
+        the signal as soon as no later frame can overlap it. Frames are
+        cross-faded with a Hann window, normalized by the summed weights.
+
+        Args:
+            channels: number of channels of the frames
+            window: length of the frames
+        """
+        self.weight = np.hanning(window + 2)[1:-1].astype(np.float32)
+        self.out = np.zeros((channels, 0), dtype=np.float32)
+        self.norm = np.zeros(0, dtype=np.float32)
+        self.start = 0
+
+    def add(self, position: int, frame: np.ndarray):
+        """
+        Adds the frame [C × window] starting at the given sample.
+        """
+        end = position + frame.shape[-1] - self.start
+        if end > self.norm.shape[-1]:
+            grow = end - self.norm.shape[-1]
+            self.out = np.pad(self.out, ((0, 0), (0, grow)))
+            self.norm = np.pad(self.norm, (0, grow))
+        i = position - self.start
+        self.out[:, i:end] += frame * self.weight
+        self.norm[i:end] += self.weight
+
+    def pop(self, until: int) -> np.ndarray:
+        """
+        Takes out the finished signal up to the given sample.
+        """
+        n = until - self.start
+        out = self.out[:, :n] / self.norm[:n]
+        self.out, self.norm = self.out[:, n:], self.norm[n:]
+        self.start = until
+        return out
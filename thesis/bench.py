@@ -0,0 +1,176 @@
+import json
+import os
+import time
+from datetime import datetime
+from glob import glob
+from itertools import chain
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+from torch.utils import data
+
+from .functional import chunk, interleave
+from .io import FileLock
+
+
+def rss(pid: int) -> int:
+    """
+    Resident set size of a process in bytes, 0 if it is not readable.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def children(pid: int) -> List[int]:
+    """
+    Process ids of the direct children of the given process.
+    """
+    pids = []
+    for stat in glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as fp:
+                # The command name can contain spaces, the ppid follows it
+                fields = fp.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(stat.split("/")[2]))
+    return pids
+
+
+def bench_loader(loader: data.DataLoader, n_batches: int, warmup: int = 2) -> Dict:
+    """
+    Measures how fast a data loader gives batches.
+
+    Args:
+        loader: the loader to measure
+        n_batches: number of batches to time
+        warmup: number of batches to skip first (worker start-up)
+
+    Returns:
+        samples/s, batch latency percentiles and the memory of the workers
+    """
+    if len(loader) == 0:
+        raise ValueError("The loader gives no batches")
+    latencies, n_samples, worker_rss = [], 0, []
+    iterator = iter(loader)
+    for i in range(warmup + n_batches):
+        start = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            iterator = iter(loader)
+            batch = next(iterator)
+        latency = time.perf_counter() - start
+        if i < warmup:
+            continue
+        latencies.append(latency)
+        while isinstance(batch, (list, tuple)):
+            batch = batch[0]
+        n_samples += batch.shape[0]
+        if i == warmup + n_batches // 2:
+            worker_rss = [rss(pid) for pid in children(os.getpid())]
+    del iterator
+
+    latencies = np.array(latencies)
+    return {
+        "samples/s": n_samples / latencies.sum(),
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "rss_main": rss(os.getpid()),
+        "rss_workers": sum(worker_rss),
+        "n_workers": len(worker_rss),
+    }
+
+
+def write_results(fp: str, records: Iterable[Dict]):
+    """
+    Appends benchmark records as JSON lines, with the time of the run.
+    """
+    stamp = datetime.today().isoformat(timespec="seconds")
+    with FileLock(fp), open(fp, "a") as file:
+        for record in records:
+            file.write(json.dumps({"time": stamp, **record}) + "\n")
+
+
+def allocated(fn: Callable, device: torch.device) -> int:
+    """
+    Number of bytes allocated while running the function.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_stats(device)["allocated_bytes.all.allocated"]
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.memory_stats(device)["allocated_bytes.all.allocated"] - before
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+
+
+def timed(fn: Callable, device: torch.device, n: int = 20) -> float:
+    """
+    Mean run time of the function in seconds.
+    """
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n
+
+
+# The split and cat channel permutations as they were before, for comparison
+def _interleave_cat(tensors, groups: int, dim: int = 1):
+    cs = tensors[0].shape[dim] // groups
+    splits = map(lambda x: torch.split(x, cs, dim=dim), tensors)
+    return torch.cat(list(chain.from_iterable(zip(*splits))), dim=dim)
+
+
+def _chunk_cat(tensor, chunks: int = 2, groups: int = 1, dim: int = 1):
+    cs = tensor.shape[dim] // (groups * chunks)
+    splits = tensor.split(cs, dim=dim)
+    return tuple(torch.cat(splits[i::chunks], dim=dim) for i in range(chunks))
+
+
+def _flip_cat(tensor, groups: int = 1, dim: int = 1):
+    up, down = _chunk_cat(tensor, groups=groups, dim=dim)
+    return _interleave_cat((down, up), groups=groups, dim=dim)
+
+
+def bench_permute(x: torch.Tensor, groups: int) -> Dict:
+    """
+    Compares the channel permutations of one coupling flow (chunk the input,
+    interleave the halves, flip) between the split/cat helpers and the
+    current ones, where the flip is fused into the interleave.
+
+    Returns:
+        allocated bytes and run time of both
+    """
+
+    def before():
+        in_a, in_b = _chunk_cat(x, groups=groups)
+        return _flip_cat(_interleave_cat((in_a, in_b), groups), groups)
+
+    def after():
+        in_a, in_b = chunk(x, groups=groups)
+        return interleave((in_b, in_a), groups)
+
+    assert torch.equal(before(), after())
+    return {
+        "bytes/before": allocated(before, x.device),
+        "bytes/after": allocated(after, x.device),
+        "time/before": timed(before, x.device),
+        "time/after": timed(after, x.device),
+    }
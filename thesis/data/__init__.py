@@ -1,24 +1,104 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+import torch
+from torch import Tensor as T
+from torch import distributed as dist
 from torch.utils import data
 from ..nn.modules import MelSpectrogram
 
 
+class MelCache(object):
+    def __init__(self, budget: int):
+        """
+        Least-recently-used store of mel-spectrograms bounded by their size.
+        Every DataLoader worker holds its own copy.
+
+        Args:
+            budget: maximum number of bytes to keep
+        """
+        self.budget, self.size = budget, 0
+        self.items = OrderedDict()
+
+    def get(self, key: Hashable, compute: Callable[[], T]) -> T:
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        value = compute()
+        nbytes = value.element_size() * value.nelement()
+        if nbytes <= self.budget:
+            self.items[key] = value
+            self.size += nbytes
+            while self.size > self.budget:
+                _, old = self.items.popitem(last=False)
+                self.size -= old.element_size() * old.nelement()
+        return value
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
 class Dataset(data.Dataset):
-    def __init__(self, sr: int = 14_700, n_mels: int = 80):
+    # Optional module applied to every batch after it is on the device
+    augment = None
+
+    def __init__(self, sr: int = 14_700, n_mels: int = 80, mel_cache: int = 0):
         self.rate = sr
         self.spectrograph = MelSpectrogram(n_mels=n_mels, sr=sr)
+        self.mel_cache = MelCache(mel_cache) if mel_cache > 0 else None
 
-    def loader(self, batch_size: int, shuffle=True, **kwargs) -> data.DataLoader:
-        return data.DataLoader(self, batch_size=batch_size, num_workers=8, shuffle=shuffle, **kwargs)
+    def loader(
+        self,
+        batch_size: int,
+        shuffle=True,
+        num_workers: int = 8,
+        pin_memory: Optional[bool] = None,
+        **kwargs,
+    ) -> data.DataLoader:
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        # In distributed training every process loads its own share
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed and not isinstance(self, data.IterableDataset):
+            kwargs["sampler"] = data.DistributedSampler(self, shuffle=shuffle)
+            shuffle = False
+        return data.DataLoader(
+            self,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            shuffle=shuffle,
+            pin_memory=pin_memory,
+            **kwargs,
+        )
 
     def __str__(self) -> str:
         return f"{type(self).__name__} with <{len(self):>7} signals>"
 
-    def _mel_get(self, signal, do_time, do_mel):
+    def _mel_get(self, signal, do_time, do_mel, mel: Optional[T] = None):
         if do_mel:
-            mel = self.spectrograph(signal.squeeze())
+            if mel is None:
+                mel = self.spectrograph(signal.squeeze())
             if do_time:
                 return signal, mel
             else:
                 return mel
         else:
             return signal
+
+    def _cached_mel(self, key: Hashable, compute: Callable[[], T]) -> T:
+        if self.mel_cache is None:
+            return compute()
+        return self.mel_cache.get(key, compute)
+
+    def _mel_window(self, mel: T, ν: int, length: int) -> T:
+        """
+        Slices the frames of the window [ν, ν + length) out of the
+        mel-spectrogram of the full signal. Gives as many frames as computing
+        the mel-spectrogram of the window itself. For ν on the frame grid all
+        but the two border frames are identical to it, the border frames see
+        the real neighbourhood instead of the padding.
+        """
+        hop = self.spectrograph.hop_length
+        n_frames = length // hop + 1
+        start = min(round(ν / hop), mel.shape[-1] - n_frames)
+        return mel[..., start : start + n_frames]
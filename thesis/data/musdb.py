@@ -1,5 +1,8 @@
 from glob import glob
+from os import makedirs, replace
+from os.path import dirname, exists, normpath
 from random import randint
+from typing import Optional
 
 import librosa
 import musdb
@@ -7,39 +10,99 @@ import numpy as np
 import torch
 
 from ..data import Dataset
+from .store import Pack, PackWriter, Shards
 from ..functional import normalize
+from ..nn.modules import MelSpectrogram
+
+# Sample rates of the mel-spectrograms and of the time signals
+MEL_SR, TIME_SR = 24_000, 14_700
 
 
 class MusDB(Dataset):
-    def __init__(self, path: str, subsets: str, mel: bool = False):
-        super(MusDB, self).__init__(sr=24_000, n_mels=265)
+    def __init__(
+        self,
+        path: str,
+        subsets: str,
+        mel: bool = False,
+        cached: Optional[bool] = False,
+        mel_cache: int = 0,
+    ):
+        """
+        Args:
+            path: root folder of the MusDB data set
+            subsets: which subset to load
+            mel: kept for compatibility, the mel-spectrograms are always returned
+            cached: whether to read the tracks from the cache written by
+                `build_cache`, None for using the cache iff it exists
+            mel_cache: byte budget for keeping the mel-spectrograms of decoded
+                tracks in memory, 0 for no cache
+        """
+        super(MusDB, self).__init__(sr=MEL_SR, n_mels=265, mel_cache=mel_cache)
         self.path, self.subsets = path, subsets
         self.mel = mel
-        self.db = musdb.DB(root=path, subsets=subsets)
-        self.time_sr = 14_700
+        self.time_sr = TIME_SR
+        self.cache_path = normpath(path) + "_cache/" + subsets + ".pack"
+        if cached is None:
+            cached = exists(self.cache_path)
+        if cached:
+            self.db, self.pack = None, Pack(self.cache_path)
+        else:
+            self.db, self.pack = musdb.DB(root=path, subsets=subsets), None
 
     def __len__(self):
+        if self.pack is not None:
+            return self.pack.meta["n"]
         return len(self.db)
 
     def __getitem__(self, idx: int):
+        if self.pack is not None:
+            # Iterating relies on an IndexError past the last track
+            if not 0 <= idx < len(self):
+                raise IndexError(idx)
+            wav = torch.from_numpy(self.pack[f"time/{idx:03}"])
+            mel = torch.from_numpy(self.pack[f"mel/{idx:03}"])
+            return wav, mel
+        return self._decode(idx)
+
+    def _decode(self, idx: int):
         track = self.db[idx]
         # Take only the left channel, do not take mean, cause of weirdness
         stems = track.stems[1:, :, 0]
         stems = np.asfortranarray(stems)
 
         # Down sample to our sample rate
-        mel_stems = librosa.resample(stems, track.rate, self.rate, res_type="polyphase")
-        time_stems = librosa.resample(stems, track.rate, self.time_sr, res_type="polyphase")
+        def compute_mel():
+            mel_stems = librosa.resample(stems, track.rate, self.rate, res_type="polyphase")
+            return self.spectrograph(torch.tensor(mel_stems, dtype=torch.float32))
 
-        mel = self.spectrograph(torch.tensor(mel_stems, dtype=torch.float32))
+        mel = self._cached_mel(("track", idx), compute_mel)
+        time_stems = librosa.resample(stems, track.rate, self.time_sr, res_type="polyphase")
 
         wav = torch.tensor(time_stems, dtype=torch.float32)
         for i in range(4):
             wav[i, :] = normalize(wav[i, :])
         return wav, mel
 
+    def build_cache(self):
+        """
+        Decodes, resamples and normalizes every track once and writes the time
+        signals and the mel-spectrograms into a single pack file. Construct
+        with `cached=True` afterwards to read the tracks from that file.
+        """
+        makedirs(dirname(self.cache_path), exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        meta = dict(n=len(self.db), sr=self.rate, time_sr=self.time_sr)
+        with PackWriter(tmp, **meta) as writer:
+            for idx in range(len(self.db)):
+                wav, mel = self._decode(idx)
+                writer.write(f"time/{idx:03}", wav.numpy())
+                writer.write(f"mel/{idx:03}", mel.numpy())
+        replace(tmp, self.cache_path)
+        self.pack = Pack(self.cache_path)
+
     def pre_save(self, n_per_song: int, length: float):
-        for i, (wav, mel) in enumerate(self):
+        for i in range(len(self)):
+            wav, mel = self[i]
             c = mel.shape[2] / wav.shape[1]
             for _ in range(n_per_song):
                 ν = randint(0, wav.shape[1] - length)
@@ -52,17 +115,47 @@ class MusDBSamples(Dataset):
     def __init__(
         self, path: str, subsets: str, space: str, length: int = False
     ):
+        """
+        Reads the samples written by `make.py musdb`. If the folder holds shards
+        those are memory-mapped, otherwise every sample is a single npy file.
+
+        Args:
+            path: root folder of the MusDB data set
+            subsets: which subset to load
+            space: either "mel" or "time"
+            length: length of the random window to take from every sample
+        """
         super(MusDBSamples, self).__init__()
         assert space in ("mel", "time")
-        path = path + "_samples/" + subsets + f"/*_{space}.npy"
-        self.files = glob(path)
+        folder = path + "_samples/" + subsets
+        shards = glob(f"{folder}/{space}_*.pack")
+        if shards:
+            self.shards, self.files = Shards(shards), None
+        else:
+            self.shards, self.files = None, glob(f"{folder}/*_{space}.npy")
         self.length = length
 
+    @staticmethod
+    def mel_frames(length: int) -> int:
+        """
+        Number of mel frames the time window of the given length spans.
+        """
+        hop = MelSpectrogram(sr=MEL_SR).hop_length
+        return length * MEL_SR // (hop * TIME_SR)
+
     def __len__(self):
+        if self.shards is not None:
+            return len(self.shards)
         return len(self.files)
 
     def __getitem__(self, idx: int):
-        x = np.load(self.files[idx])
-        ν = randint(0, x.shape[-1] - self.length)
-        x = torch.from_numpy(x[..., ν:ν+self.length])
+        if self.shards is not None:
+            x = self.shards[idx]
+        else:
+            x = np.load(self.files[idx])
+        if self.length is not False:
+            ν = randint(0, x.shape[-1] - self.length)
+            x = x[..., ν:ν+self.length]
+        # Only copies the window out of the memory-map
+        x = torch.from_numpy(np.ascontiguousarray(x))
         return x
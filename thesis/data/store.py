@@ -0,0 +1,227 @@
+import json
+import struct
+from os import remove, replace
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+MAGIC = b"THESISPK"
+ALIGN = 64
+
+
+class PackWriter(object):
+    """
+    Writes named arrays into one flat file. The arrays are stored back to back
+    (aligned to 64 bytes) and a JSON table with offset, shape and dtype of
+    every array is appended as a footer, so the file can be written streaming
+    and mapped into memory afterwards with `Pack`.
+    """
+
+    def __init__(self, fp: str, **meta):
+        self.fp = fp
+        self.meta = meta
+        self.entries: Dict[str, Dict] = {}
+        self._last = None
+        self._reserved = []
+        self._file = open(fp, "wb")
+        self._file.write(MAGIC)
+
+    def _align(self):
+        pad = -self._file.tell() % ALIGN
+        self._file.write(b"\0" * pad)
+
+    def write(self, key: str, array: np.ndarray):
+        """
+        Writes a complete array under the given key.
+        """
+        if key in self.entries:
+            raise KeyError(f"{key} already in {self.fp}")
+        array = np.ascontiguousarray(array)
+        self._align()
+        self.entries[key] = dict(
+            offset=self._file.tell(), shape=list(array.shape), dtype=array.dtype.str
+        )
+        self._file.write(array.tobytes())
+        self._last = key
+
+    def append(self, key: str, row: np.ndarray):
+        """
+        Appends one row to the array under the given key. The array grows along
+        its first axis. Rows of one key have to be appended consecutively.
+        """
+        row = np.ascontiguousarray(row)
+        if key not in self.entries:
+            self.write(key, row[None, ...])
+            return
+        entry = self.entries[key]
+        if key != self._last:
+            raise KeyError(f"Can only append to the last written array, not {key}")
+        if entry["shape"][1:] != list(row.shape) or entry["dtype"] != row.dtype.str:
+            raise ValueError(f"Row of shape {row.shape} does not fit {key}")
+        self._file.write(row.tobytes())
+        entry["shape"][0] += 1
+
+    def reserve(self, key: str, shape: Tuple[int, ...], dtype=np.float32) -> np.memmap:
+        """
+        Reserves space for an array under the given key. The array is filled
+        through the returned memory-map, which stays valid until `close`.
+        """
+        if key in self.entries:
+            raise KeyError(f"{key} already in {self.fp}")
+        dtype = np.dtype(dtype)
+        self._align()
+        offset = self._file.tell()
+        self.entries[key] = dict(offset=offset, shape=list(shape), dtype=dtype.str)
+        self._file.seek(offset + dtype.itemsize * int(np.prod(shape)))
+        self._file.truncate()
+        self._file.flush()
+        self._last = key
+        array = np.memmap(
+            self._file.name, dtype=dtype, mode="r+", offset=offset, shape=tuple(shape)
+        )
+        self._reserved.append(array)
+        return array
+
+    def close(self):
+        for array in self._reserved:
+            array.flush()
+        self._reserved = []
+        footer = json.dumps(dict(entries=self.entries, meta=self.meta)).encode()
+        self._file.write(footer)
+        self._file.write(struct.pack("<Q", len(footer)))
+        self._file.close()
+
+    def abort(self):
+        """
+        Closes and removes the partially written file, without a footer it
+        could not be read anyway.
+        """
+        self._reserved = []
+        self._file.close()
+        remove(self.fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Pack(object):
+    """
+    Read access to a file written by `PackWriter`. The whole file is mapped
+    copy-on-write once and every array is a zero-copy view into that map. The
+    map is not pickled, so DataLoader workers re-open the file themselves.
+    """
+
+    def __init__(self, fp: str):
+        self.fp = fp
+        with open(fp, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{fp} is not a pack file")
+            file.seek(-8, 2)
+            (n,) = struct.unpack("<Q", file.read(8))
+            file.seek(-8 - n, 2)
+            footer = json.loads(file.read(n).decode())
+        self.entries, self.meta = footer["entries"], footer["meta"]
+        self._buffer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        return state
+
+    @property
+    def buffer(self) -> np.memmap:
+        if self._buffer is None:
+            self._buffer = np.memmap(self.fp, dtype=np.uint8, mode="c")
+        return self._buffer
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        entry = self.entries[key]
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        start = entry["offset"]
+        stop = start + dtype.itemsize * int(np.prod(shape))
+        return self.buffer[start:stop].view(dtype).reshape(shape)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def keys(self) -> Iterable[str]:
+        return self.entries.keys()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ShardWriter(object):
+    """
+    Streams equally shaped rows into a series of packs with at most
+    `shard_size` rows each, named `{prefix}_{k:03}.pack`. A shard only gets its
+    final name after it has been completely written.
+    """
+
+    def __init__(self, prefix: str, shard_size: int = 1_000, **meta):
+        self.prefix, self.shard_size, self.meta = prefix, shard_size, meta
+        self.n_shards, self._rows, self._writer = 0, 0, None
+
+    @property
+    def _fp(self) -> str:
+        return f"{self.prefix}_{self.n_shards:03}.pack"
+
+    def append(self, row: np.ndarray):
+        if self._writer is None:
+            self._writer = PackWriter(self._fp + ".tmp", **self.meta)
+        self._writer.append("data", row)
+        self._rows += 1
+        if self._rows == self.shard_size:
+            self._finish()
+
+    def _finish(self):
+        self._writer.close()
+        replace(self._fp + ".tmp", self._fp)
+        self.n_shards, self._rows, self._writer = self.n_shards + 1, 0, None
+
+    def close(self):
+        if self._writer is not None:
+            self._finish()
+
+    def abort(self):
+        """
+        Removes the shard that is being written, the finished ones are kept.
+        """
+        if self._writer is not None:
+            self._writer.abort()
+            self._rows, self._writer = 0, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Shards(object):
+    """
+    Reads the rows of all shards written by one or several `ShardWriter` as one
+    indexable sequence. The offset table maps a global index to its shard.
+    """
+
+    def __init__(self, fps: List[str]):
+        self.packs = [Pack(fp) for fp in sorted(fps)]
+        self.offsets = np.cumsum([0] + [p.entries["data"]["shape"][0] for p in self.packs])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        k = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.packs[k]["data"][idx - self.offsets[k]]
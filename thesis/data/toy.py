@@ -1,20 +1,25 @@
+from copy import deepcopy
 from glob import glob
+from os.path import exists
 from random import randint
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 from typing import Union
 
 import numpy as np
 import torch
+from torch import Tensor as T
+from torch import distributed as dist
+from torch import nn
+from torch.utils import data
 
-from ..audio import rand_period_phase, oscillator
+from ..audio import rand_periods_phases, oscillators
 from ..data import Dataset
+from .store import Pack
 
 
-class ToyData(Dataset):
+class _Toy(Dataset):
     def __init__(
         self,
-        path: str,
-        subset: str,
         mix: bool = False,
         mel_mix: bool = False,
         source: Union[bool, int] = False,
@@ -23,9 +28,10 @@ class ToyData(Dataset):
         noise: float = 0.0,
         length: int = False,
         shuffle_indexed: bool = False,
+        batch_augment: bool = False,
+        mel_cache: int = 0,
     ):
-        super(ToyData, self).__init__(n_mels=265)
-        self.files = glob(f"{path}/{subset}/*npy")
+        super(_Toy, self).__init__(n_mels=265, mel_cache=mel_cache)
         self.mix, self.mel_mix = mix, mel_mix
         self.rand_A = rand_amplitude
         self.noise = noise
@@ -42,38 +48,36 @@ class ToyData(Dataset):
 
         assert mix or mel_mix or self.source or self.mel_source
 
-    def __len__(self):
-        return len(self.files)
+        # If set the items are only the raw windows and the augmentation is
+        # applied to the whole batch on the device, see `ToyAugment`.
+        self.augment = ToyAugment(self) if batch_augment else None
 
-    def __getitem__(self, idx: int):
-        datum = np.load(self.files[idx], allow_pickle=True).item()
-        mix = torch.tensor(datum["mix"], dtype=torch.float32).unsqueeze(0)
-        sources = torch.tensor(datum["sources"], dtype=torch.float32)
-
-        if self.k != "all":
-            sources = sources[None, self.k, :].contiguous()
-
-        if self.length is not False:
-            L = mix.shape[-1]
-            ν = randint(0, L - self.length)
-            mix = mix[..., ν : ν + self.length]
-            sources = sources[..., ν : ν + self.length]
+    def _augment(
+        self,
+        mix: T,
+        sources: T,
+        generator: Optional[torch.Generator] = None,
+        mels: Tuple[Optional[T], Optional[T]] = (None, None),
+    ):
+        if self.augment is not None:
+            return mix, sources
 
         if self.rand_A > 0:
-            A = torch.rand(sources.shape[0], 1) * self.rand_A
+            A = torch.rand(sources.shape[0], 1, generator=generator) * self.rand_A
             sources = (A + (1.0 - self.rand_A)) * sources
             mix = sources.mean(0, keepdim=True)
 
         if self.noise > 0:
-            noise = self.noise * np.random.rand() * torch.randn_like(sources)
+            σ = self.noise * torch.rand(1, generator=generator)
+            noise = σ * torch.randn(sources.shape, generator=generator)
             sources = (sources + noise).clamp(-1, 1)
             mix = sources.mean(0, keepdim=True)
 
-        sources = self._mel_get(sources, self.source, self.mel_source)
-        mix = self._mel_get(mix, self.mix, self.mel_mix)
+        sources = self._mel_get(sources, self.source, self.mel_source, mels[1])
+        mix = self._mel_get(mix, self.mix, self.mel_mix, mels[0])
 
         if self.shuffle_indexed:
-            idx = torch.randperm(sources.shape[0])
+            idx = torch.randperm(sources.shape[0], generator=generator)
             sources = sources[idx, ...], idx
 
         if self.mix:
@@ -84,8 +88,233 @@ class ToyData(Dataset):
             return sources
 
 
-def generate_toy(length: int, ns: int) -> Dict:
-    signals = []
+class ToyAugment(nn.Module):
+    def __init__(self, dataset: _Toy):
+        """
+        Applies the amplitude, noise, mel and shuffle augmentations of a toy
+        data set to a whole batch at once, after it has been moved to the
+        device. Every item still gets its own random amplitudes, noise level
+        and permutation.
+
+        Args:
+            dataset: the data set whose options to apply
+        """
+        super(ToyAugment, self).__init__()
+        self.rand_A, self.noise = dataset.rand_A, dataset.noise
+        self.mix, self.mel_mix = dataset.mix, dataset.mel_mix
+        self.source, self.mel_source = dataset.source, dataset.mel_source
+        self.shuffle_indexed = dataset.shuffle_indexed
+        self.spectrograph = deepcopy(dataset.spectrograph)
+
+    def _mel_get(self, signal: T, do_time: bool, do_mel: bool):
+        if not do_mel:
+            return signal
+        mel = self.spectrograph(signal.squeeze(1) if signal.shape[1] == 1 else signal)
+        return (signal, mel) if do_time else mel
+
+    def forward(self, mix: T, sources: T) -> Tuple:
+        (N, C, _), device = sources.shape, sources.device
+        if self.rand_A > 0:
+            A = torch.rand((N, C, 1), device=device) * self.rand_A
+            sources = (A + (1.0 - self.rand_A)) * sources
+            mix = sources.mean(1, keepdim=True)
+
+        if self.noise > 0:
+            σ = self.noise * torch.rand((N, 1, 1), device=device)
+            sources = (sources + σ * torch.randn_like(sources)).clamp(-1, 1)
+            mix = sources.mean(1, keepdim=True)
+
+        sources = self._mel_get(sources, self.source, self.mel_source)
+        mix = self._mel_get(mix, self.mix, self.mel_mix)
+
+        if self.shuffle_indexed:
+            idx = torch.rand((N, C), device=device).argsort(1)
+            sources = sources[torch.arange(N, device=device)[:, None], idx], idx
+
+        # Same structure as `prepare_batch` gives for the per-item outputs
+        if self.mix and self.source:
+            return mix, sources
+        out = mix if self.mix else sources
+        return out if isinstance(out, tuple) else (out,)
+
+
+class ToyData(_Toy):
+    def __init__(
+        self,
+        path: str,
+        subset: str,
+        mix: bool = False,
+        mel_mix: bool = False,
+        source: Union[bool, int] = False,
+        mel_source: Union[bool, int] = False,
+        rand_amplitude: float = 0.0,
+        noise: float = 0.0,
+        length: int = False,
+        shuffle_indexed: bool = False,
+        batch_augment: bool = False,
+        mel_cache: int = 0,
+    ):
+        """
+        Args:
+            path: root folder of the toy data
+            subset: which subset to load
+            mix: whether to give the mix
+            mel_mix: whether to give the mel-spectrogram of the mix
+            source: whether to give the sources, or the index of the one source
+            mel_source: whether to give the mel-spectrograms of the sources,
+                or the index of the one source
+            rand_amplitude: maximal random down-scaling of the sources
+            noise: maximal level of additive noise
+            length: length of the random window, False for the full signals
+            shuffle_indexed: whether to permute the sources and give the
+                permutation
+            batch_augment: whether to leave the augmentation to `ToyAugment`
+            mel_cache: byte budget for caching the mel-spectrograms of the
+                full signals, 0 for no cache. Only used without amplitude and
+                noise augmentation, as those change the spectrograms.
+        """
+        super(ToyData, self).__init__(
+            mix=mix,
+            mel_mix=mel_mix,
+            source=source,
+            mel_source=mel_source,
+            rand_amplitude=rand_amplitude,
+            noise=noise,
+            length=length,
+            shuffle_indexed=shuffle_indexed,
+            batch_augment=batch_augment,
+            mel_cache=mel_cache,
+        )
+        if exists(f"{path}/{subset}.pack"):
+            self.pack, self.files = Pack(f"{path}/{subset}.pack"), None
+        else:
+            self.pack, self.files = None, glob(f"{path}/{subset}/*npy")
+
+    def __len__(self):
+        if self.pack is not None:
+            return self.pack.entries["sources"]["shape"][0]
+        return len(self.files)
+
+    def _load(self, idx: int):
+        if self.pack is not None:
+            return self.pack["mix"][None, idx], self.pack["sources"][idx]
+        datum = np.load(self.files[idx], allow_pickle=True).item()
+        return datum["mix"][None, :], datum["sources"]
+
+    def __getitem__(self, idx: int):
+        mix, sources = self._load(idx)
+
+        if self.k != "all":
+            sources = sources[None, self.k, :]
+
+        ν = 0
+        mels = self._full_mels(idx, mix, sources)
+        if self.length is not False:
+            L = mix.shape[-1]
+            if mels == (None, None):
+                ν = randint(0, L - self.length)
+            else:
+                # Windows on the frame grid so the sliced mels line up exactly
+                hop = self.spectrograph.hop_length
+                ν = hop * randint(0, (L - self.length) // hop)
+            mix = mix[..., ν : ν + self.length]
+            sources = sources[..., ν : ν + self.length]
+            mels = tuple(
+                m if m is None else self._mel_window(m, ν, self.length) for m in mels
+            )
+
+        mix = torch.tensor(mix, dtype=torch.float32)
+        sources = torch.tensor(sources, dtype=torch.float32)
+        return self._augment(mix, sources, mels=mels)
+
+    def _full_mels(self, idx: int, mix: np.ndarray, sources: np.ndarray):
+        cached = self.mel_cache is not None and self.augment is None
+        if not cached or self.rand_A > 0 or self.noise > 0:
+            return None, None
+
+        def mel(name, signal):
+            signal = torch.tensor(signal, dtype=torch.float32)
+            return self._cached_mel((name, idx), lambda: self.spectrograph(signal.squeeze()))
+
+        return (
+            mel("mix", mix) if self.mel_mix else None,
+            mel("sources", sources) if self.mel_source else None,
+        )
+
+
+class ToyStream(_Toy, data.IterableDataset):
+    def __init__(
+        self,
+        n: int = 5_000,
+        seed: int = 0,
+        resample: bool = True,
+        ns: int = 4,
+        chunk: int = 64,
+        **kwargs,
+    ):
+        """
+        Synthesizes the toy data on the fly instead of reading it from disk.
+        Takes the same outputs and augmentations as `ToyData`.
+
+        Args:
+            n: number of items per pass
+            seed: base seed of the stream
+            resample: whether to draw new items in every pass, otherwise every
+                pass gives the same items (e.g. for a test set)
+            ns: number of sources
+            chunk: number of items synthesized at once
+            **kwargs: see `ToyData`
+        """
+        super(ToyStream, self).__init__(**kwargs)
+        self.n, self.seed, self.resample = n, seed, resample
+        self.ns, self.chunk = ns, chunk
+        self._passes = 0
+
+    def __len__(self):
+        return self.n
+
+    def loader(self, batch_size: int, shuffle=True, **kwargs) -> data.DataLoader:
+        # An iterable data set cannot be shuffled by the loader, every item is
+        # random anyways
+        return super(ToyStream, self).loader(batch_size, shuffle=False, **kwargs)
+
+    def __iter__(self):
+        info = data.get_worker_info()
+        if info is None:
+            worker, n_workers, pass_seed = 0, 1, self._passes
+            self._passes += 1
+        else:
+            # The DataLoader draws a new base seed for every pass from the
+            # global torch RNG, so runs with a fixed torch seed are repeatable
+            worker, n_workers, pass_seed = info.id, info.num_workers, info.seed - info.id
+        if dist.is_available() and dist.is_initialized():
+            # The workers of all processes of a distributed training share
+            # the stream
+            worker += dist.get_rank() * n_workers
+            n_workers *= dist.get_world_size()
+        entropy = [self.seed, worker] + ([pass_seed % 2 ** 32] if self.resample else [])
+        rng = np.random.default_rng(entropy)
+        generator = torch.Generator().manual_seed(int(rng.integers(2 ** 63)))
+
+        length = 48_000 if self.length is False else self.length
+        n = len(range(worker, self.n, n_workers))
+        for i in range(0, n, self.chunk):
+            batch = generate_toy_batch(min(self.chunk, n - i), length, self.ns, rng=rng)
+            for sources, mix in zip(batch["sources"], batch["mix"]):
+                if self.k != "all":
+                    sources = sources[None, self.k, :]
+                mix = torch.from_numpy(mix[None, :])
+                sources = torch.from_numpy(np.ascontiguousarray(sources))
+                yield self._augment(mix, sources, generator)
+
+
+def toy_shapes(ns: int) -> List[Tuple[str, str, int, int]]:
+    """
+    Gives the sources of the toy data with ns sources.
+
+    Returns:
+        list of (name, oscillator shape, highest key, lowest key)
+    """
     shapes = [
         "sin",
         "square",
@@ -96,24 +325,52 @@ def generate_toy(length: int, ns: int) -> Dict:
         "reversesaw",
         "noise",
     ]
-    item = {"shape": [], "ν": [], "φ": []}
     if ns > 5:
         shapes[1] = "high_square"
-    for i, s in zip(range(ns), shapes):
-        item["shape"].append(s)
-        high, low = 65, 1
+    sources = []
+    for s in shapes[:ns]:
+        high, low, shape = 65, 1, s
         if s.startswith("high_"):
             low = 50
-            s = s[5:]
+            shape = s[5:]
         if s.startswith("low_"):
             high = 40
-            s = s[4:]
-        ν, φ = rand_period_phase(high, low)
-        signals.append(oscillator(length, s, ν, φ))
-        item["ν"].append(ν)
-        item["φ"].append(φ)
-    sources = np.concatenate(signals, axis=0)
-    λ = np.ones(ns) / ns
-    mix = λ @ sources
-
-    return {"sources": sources, "mix": mix, **item}
+            shape = s[4:]
+        sources.append((s, shape, high, low))
+    return sources
+
+
+def generate_toy_batch(
+    n: int, length: int, ns: int, rng: Optional[np.random.Generator] = None
+) -> Dict:
+    """
+    Generates n toy items at once.
+
+    Args:
+        n: number of items
+        length: length of the signals
+        ns: number of sources
+        rng: random generator, defaults to one seeded from the global state
+
+    Returns:
+        dense arrays sources [n×ns×length], mix [n×length], ν and φ [n×ns]
+        and the list of shapes (same for all items)
+    """
+    names, shapes, high, low = zip(*toy_shapes(ns))
+    ν, φ = np.empty((n, ns), dtype=np.int64), np.empty((n, ns), dtype=np.int64)
+    for k in range(ns):
+        ν[:, k], φ[:, k] = rand_periods_phases(n, high[k], low[k], rng=rng)
+    sources = oscillators(length, shapes, ν, φ, rng=rng)
+    mix = sources.mean(1)
+    return {"sources": sources, "mix": mix, "ν": ν, "φ": φ, "shape": list(names)}
+
+
+def generate_toy(length: int, ns: int) -> Dict:
+    batch = generate_toy_batch(1, length, ns)
+    return {
+        "sources": batch["sources"][0],
+        "mix": batch["mix"][0],
+        "shape": batch["shape"],
+        "ν": batch["ν"][0].tolist(),
+        "φ": batch["φ"][0].tolist(),
+    }
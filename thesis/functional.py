@@ -1,5 +1,4 @@
-from itertools import chain
-from typing import Tuple
+from typing import Callable, Iterator, Optional, Tuple
 
 import torch
 from torch import Tensor as T
@@ -50,32 +49,105 @@ def normalize(waveform: T):
 
 
 def interleave(tensors: Tuple[T, ...], groups: int, dim: int = 1) -> T:
-    cs = tensors[0].shape[dim] // groups
-    splits = map(lambda x: torch.split(x, cs, dim=dim), tensors)
-    return torch.cat(list(chain.from_iterable(zip(*splits))), dim=dim)
+    """
+    Inverse of `chunk`: interleaves the tensors group-wise along `dim`. Costs
+    one copy (a single cat) instead of a split and cat per group.
+    """
+    dim = dim % tensors[0].dim()
+    shape = tensors[0].shape
+    grouped = [
+        x.reshape(*x.shape[:dim], groups, -1, *x.shape[dim + 1 :]) for x in tensors
+    ]
+    out = torch.cat(grouped, dim=dim + 1)
+    return out.view(*shape[:dim], -1, *shape[dim + 1 :])
 
 
 def chunk(tensor: T, chunks: int = 2, groups: int = 1, dim: int = 1) -> Tuple[T, ...]:
+    """
+    Splits every one of the `groups` channel groups into `chunks` parts and
+    returns the parts with the same index together. For a single group the
+    parts are views, otherwise each part costs one copy.
+    """
+    dim = dim % tensor.dim()
+    pre, post = tensor.shape[:dim], tensor.shape[dim + 1 :]
     cs = tensor.shape[dim] // (groups * chunks)  # Size of one chunk
-    splits = tensor.split(cs, dim=dim)
-    chunks = tuple(torch.cat(splits[i::chunks], dim=dim) for i in range(chunks))
-    return chunks
+    grouped = tensor.reshape(*pre, groups, chunks, cs, *post)
+    return tuple(
+        grouped.select(dim + 1, i).reshape(*pre, groups * cs, *post)
+        for i in range(chunks)
+    )
 
 
 def permute_L2C(x: T, factor: int = 2) -> T:
     N, C, L = x.shape
-    squeezed = x.view(N, C, L // factor, factor).permute(0, 1, 3, 2)
+    squeezed = x.reshape(N, C, L // factor, factor).permute(0, 1, 3, 2)
     out = squeezed.contiguous().view(N, C * factor, L // factor)
     return out
 
 
 def permute_C2L(x: T, factor: int = 2) -> T:
     N, C, L = x.shape
-    out = x.view(N, C // factor, factor, L).permute(0, 1, 3, 2)
+    out = x.reshape(N, C // factor, factor, L).permute(0, 1, 3, 2)
     out = out.contiguous().view(N, C // factor, L * factor)
     return out
 
 
 def flip(tensor: T, chunks: int = 2, groups: int = 1, dim: int = 1) -> T:
-    up, down = chunk(tensor, chunks=chunks, groups=groups, dim=dim)
-    return interleave((down, up), groups=groups, dim=dim)
+    """
+    Reverses the order of the chunks inside every group, in one copy. Same as
+    `interleave(chunk(tensor)[::-1])`.
+    """
+    dim = dim % tensor.dim()
+    pre, post = tensor.shape[:dim], tensor.shape[dim + 1 :]
+    grouped = tensor.reshape(*pre, groups, chunks, -1, *post)
+    return grouped.flip(dim + 1).view(tensor.shape)
+
+
+def iter_chunked(
+    fn: Callable[..., T],
+    *tensors: Optional[T],
+    size: int,
+    context: Tuple[int, int],
+    align: int = 1,
+) -> Iterator[T]:
+    """
+    Applies a translation equivariant function, like a conv net, to long
+    signals in windows along the last axis. Every window carries `context`
+    extra input samples on both sides, so the stitched outputs equal the
+    output of `fn` on the whole signal while memory stays bounded by the
+    window size.
+
+    Args:
+        fn: function of the windows of all tensors, gives one tensor of the
+            same length
+        tensors: the signals [… × L], None is passed on as None
+        size: number of output samples per window
+        context: number of input samples left and right that one output
+            sample depends on
+        align: window bounds are kept to multiples of this
+
+    Yields:
+        the consecutive pieces of the output
+    """
+    L = next(x for x in tensors if x is not None).shape[-1]
+    left, right = (-(-c // align) * align for c in context)
+    size = -(-size // align) * align
+    for start in range(0, L, size):
+        stop = min(start + size, L)
+        a, b = max(start - left, 0), min(stop + right, L)
+        out = fn(*(x[..., a:b] if x is not None else None for x in tensors))
+        yield out[..., start - a : stop - a]
+
+
+def chunked(
+    fn: Callable[..., T],
+    *tensors: Optional[T],
+    size: int,
+    context: Tuple[int, int],
+    align: int = 1,
+) -> T:
+    """
+    Same as `fn(*tensors)` but computed in windows, see `iter_chunked`.
+    """
+    pieces = iter_chunked(fn, *tensors, size=size, context=context, align=align)
+    return torch.cat(list(pieces), dim=-1)
@@ -1,20 +1,29 @@
+import json
 import os
+import queue
+import socket
+import threading
 import time
 import warnings
 from collections import OrderedDict
+from datetime import datetime
+from fnmatch import fnmatch
 from glob import glob
 from os import path
-from pathlib import Path
 from random import random
-from typing import Any, Type
+from typing import Any, Dict, List, Tuple, Type
 from typing import Optional as Opt
 
 import ipdb
-import numpy as np
 import torch
 from colorama import Fore
 from torch.serialization import SourceChangeWarning
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from .setup import DEFAULT_CHECKPOINTS
 from .utils import get_func_arguments
 
@@ -35,14 +44,121 @@ def get_newest_file(folder: str, match: str = "*pt"):
     return chosen
 
 
+class CheckpointIndex(object):
+    def __init__(self, folder: str = DEFAULT_CHECKPOINTS):
+        """
+        Registry of the checkpoints in a folder as append-only JSON lines,
+        so finding one does not need to scan the folder. Every line records
+        a written or a removed checkpoint, the last line of a file counts.
+
+        Args:
+            folder: the checkpoint folder, holding index.jsonl
+        """
+        self.folder = folder
+        self.fp = path.join(folder, "index.jsonl")
+        # In the order written, so the last one is the newest
+        self._entries: Dict[str, Dict] = OrderedDict()
+        self._read = 0
+
+    def add(self, fp: str, **info):
+        """
+        Registers the checkpoint, with its model class, params, iteration,
+        test loss, … as info.
+        """
+        stamp = datetime.today().isoformat(timespec="seconds")
+        self._append({"path": path.basename(fp), "time": stamp, **info})
+
+    def remove(self, fp: str):
+        self._append({"path": path.basename(fp), "removed": True})
+
+    def entries(self) -> Dict[str, Dict]:
+        """
+        The registered checkpoints by file name, only reading the lines that
+        are new since the last call.
+        """
+        if not path.exists(self.fp):
+            return self._entries
+        with open(self.fp, "rb") as file:
+            file.seek(self._read)
+            for line in file:
+                # A line that is still being written is read next time
+                if not line.endswith(b"\n"):
+                    break
+                self._read += len(line)
+                entry = json.loads(line)
+                self._entries.pop(entry["path"], None)
+                if not entry.get("removed", False):
+                    self._entries[entry["path"]] = entry
+        return self._entries
+
+    def find(
+        self, match: str = "*", by: str = "newest", name: Opt[str] = None
+    ) -> Opt[str]:
+        """
+        Args:
+            match: glob pattern of the file name
+            by: `newest` for the latest one, `best` for the lowest test loss
+            name: name of the experiment the model was trained with
+
+        Returns:
+            path of the checkpoint, None if there is no match
+        """
+        entries = [
+            entry
+            for file_name, entry in self.entries().items()
+            if fnmatch(file_name, match) and (name is None or entry.get("name") == name)
+        ]
+        if by == "best":
+            entries = [entry for entry in entries if entry.get("test") is not None]
+            entries = sorted(entries, key=lambda entry: -entry["test"])
+        elif by != "newest":
+            raise ValueError(f"Unknown order {by}")
+        if not entries:
+            return None
+        return path.join(self.folder, entries[-1]["path"])
+
+    def _append(self, entry: Dict):
+        os.makedirs(self.folder, exist_ok=True)
+        line = json.dumps(entry, default=str) + "\n"
+        # One write of an appended line, so readers never see half of it.
+        # Appends are not atomic on network file systems, hence the lock.
+        with FileLock(self.fp):
+            fd = os.open(self.fp, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+
+
 def get_newest_checkpoint(match: str = "*pt"):
+    """
+    Finds a checkpoint in the index of the checkpoint folder by the glob
+    pattern, the newest one or with `best:` as prefix the one with the
+    lowest test loss. Checkpoints that are not indexed are found by the
+    modification time of the files, but never as the best one.
+    """
     if "*" not in match and path.exists(match):
         return match
+    by = "newest"
+    if match.startswith("best:"):
+        by, match = "best", match[len("best:"):]
     if not match.endswith("pt"):
         if not match.endswith("*"):
             match += "*"
         match += "pt"
-    return get_newest_file(DEFAULT_CHECKPOINTS, match)
+    chosen = CheckpointIndex(DEFAULT_CHECKPOINTS).find(match, by=by)
+    if chosen is None or not path.exists(chosen):
+        if by == "best":
+            # Only the index knows the test losses
+            print(
+                f"{Fore.RED}No indexed checkpoint with a test loss\n\t{Fore.YELLOW}{DEFAULT_CHECKPOINTS}/{match}\n{Fore.GREEN}Give me something better{Fore.RESET}."
+            )
+            exit(1)
+        return get_newest_file(DEFAULT_CHECKPOINTS, match)
+    print(
+        f"{Fore.YELLOW}For {Fore.GREEN}{match} {Fore.YELLOW}we using\t{Fore.GREEN}{chosen}{Fore.RESET}"
+    )
+    return chosen
 
 
 def glob_remove(path: str):
@@ -50,35 +166,245 @@ def glob_remove(path: str):
         os.remove(fp)
 
 
-def save_append(fp: str, obj: Any):
+def to_cpu(obj: Any) -> Any:
+    """
+    Copy of a (nested) state dict with all tensors moved to the CPU.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj: Any, fp: str):
+    """
+    Saves to a temporary file next to the target and renames it, so that
+    the file at fp is always complete, even if the process gets killed.
+    """
+    tmp = f"{fp}.tmp"
+    with open(tmp, "wb") as file:
+        torch.save(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, fp)
+    # Makes the rename itself durable
+    fd = os.open(path.dirname(path.abspath(fp)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# The optimizer and scheduler state are saved next to the model as
+OPTIM_SUFFIX = ".optim"
+OPTIM_KEYS = ("optimizer_state_dict", "scheduler")
+# and the params to build the model with as
+PARAMS_SUFFIX = ".params"
+
+
+class CheckpointWriter(object):
+    def __init__(
+        self,
+        keep_last: Opt[int] = 1,
+        keep_best: int = 0,
+        index: Opt[CheckpointIndex] = None,
+    ):
+        """
+        Writes checkpoints on a background thread. The training only waits
+        for the copy of the state to the CPU, and for the previous write if
+        that is still going on. Files are written atomically, then the
+        retention policy removes the checkpoints not worth keeping. The
+        optimizer and scheduler state go to a separate file, so that loading
+        just the model does not have to read them, and so do the params, so
+        that the model can be built without reading the weights.
+
+        Args:
+            keep_last: number of newest checkpoints to keep, None for all
+            keep_best: number of checkpoints with the lowest score to keep
+            index: registry to record the written and removed checkpoints
+        """
+        self.keep_last, self.keep_best, self.index = keep_last, keep_best, index
+        # (file, score) of the written checkpoints, oldest first
+        self.written: List[Tuple[str, Opt[float]]] = []
+        self.error: Opt[BaseException] = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def save(self, save_point: Dict, fp: str, score: Opt[float] = None):
+        """
+        Args:
+            save_point: the state to save
+            fp: path of the checkpoint
+            score: value to rank the checkpoints by, lower is better
+        """
+        self._raise()
+        self._queue.put((to_cpu(save_point), fp, score))
+
+    def close(self):
+        """
+        Waits until all checkpoints are written.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            save_point, fp, score = item
+            try:
+                info = _describe(save_point)
+                optim = {k: save_point.pop(k) for k in OPTIM_KEYS if k in save_point}
+                if optim:
+                    atomic_save(optim, fp + OPTIM_SUFFIX)
+                if "params" in save_point:
+                    atomic_save({"params": save_point.pop("params")}, fp + PARAMS_SUFFIX)
+                # Written last, a complete checkpoint has its other files too
+                atomic_save(save_point, fp)
+                self.written.append((fp, score))
+                if self.index is not None:
+                    self.index.add(fp, test=score, **info)
+                self._retain()
+            except Exception as e:
+                self.error = e
+
+    def _retain(self):
+        if self.keep_last is None:
+            return
+        keep = {fp for fp, _ in self.written[-self.keep_last :]} if self.keep_last else set()
+        scored = [(score, fp) for fp, score in self.written if score is not None]
+        keep.update(fp for _, fp in sorted(scored)[: self.keep_best])
+        for fp, _ in self.written:
+            if fp not in keep and path.exists(fp):
+                os.remove(fp)
+                for suffix in [OPTIM_SUFFIX, PARAMS_SUFFIX]:
+                    if path.exists(fp + suffix):
+                        os.remove(fp + suffix)
+                if self.index is not None:
+                    self.index.remove(fp)
+        self.written = [(fp, score) for fp, score in self.written if fp in keep]
+
+
+def _describe(save_point: Dict) -> Dict:
+    params = save_point.get("params", {})
+    kwargs = params.get("kwargs", {})
+    model_class = params.get("__class__")
+    return {
+        "model": getattr(model_class, "__name__", None),
+        "name": kwargs.get("name"),
+        "params": kwargs,
+        "it": save_point.get("it"),
+    }
+
+
+def _torch_load(fp: str, device: str) -> Any:
+    """
+    Loads with the tensors memory-mapped, so that only the parts that are
+    used are read. Files in the legacy format and older versions of torch
+    load the whole file.
+    """
+    try:
+        return torch.load(fp, map_location=torch.device(device), mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        return torch.load(fp, map_location=torch.device(device))
+
+
+def load_params(fp: str) -> Opt[Dict]:
+    """
+    Loads only the params to build the model of a checkpoint with, without
+    reading the weights. None for checkpoints of whole pickled models.
+    """
+    if path.exists(fp + PARAMS_SUFFIX):
+        return _torch_load(fp + PARAMS_SUFFIX, "cpu")["params"]
+    # Older checkpoints hold the params, their tensors are only mapped
+    return _torch_load(fp, "cpu").get("params")
+
+
+def load_checkpoint(fp: str, device: str = "cpu", optim: bool = False) -> Dict:
     """
-    Appends to a pickled torch save. Create file if not exists.
+    Loads a checkpoint. The params and the optimizer and scheduler state are
+    saved apart from the model (see `CheckpointWriter`), the latter are only
+    loaded with optim.
+
     Args:
-        fp: Path to file
-        obj: New obj to append
+        fp: path of the checkpoint
+        device: device to map the tensors to
+        optim: whether to also load the optimizer and scheduler state
+
+    Returns:
+        the checkpoint
     """
-    fp = path.abspath(fp)
-    if path.exists(fp):
-        data = torch.load(fp)
-    else:
-        data = [obj]
-    data.append(obj)
-    torch.save(data, fp)
+    save_point = _torch_load(fp, device)
+    if path.exists(fp + PARAMS_SUFFIX):
+        save_point.update(_torch_load(fp + PARAMS_SUFFIX, device))
+    if optim and path.exists(fp + OPTIM_SUFFIX):
+        save_point.update(_torch_load(fp + OPTIM_SUFFIX, device))
+    return save_point
+
+
+# Models built by load_model by (path, mtime, device, class)
+_MODELS: Dict[Tuple[str, float, str, Opt[Type]], Any] = {}
 
 
 def load_model(
-    fp: str, device: str, train: bool = False, model_class: Opt[Type] = None
+    fp: str,
+    device: str,
+    train: bool = False,
+    model_class: Opt[Type] = None,
+    cache: bool = True,
 ):
-    save_point = torch.load(fp, map_location=torch.device(device))
+    """
+    Loads the model of a checkpoint for evaluation, or with train also its
+    optimizer and scheduler state and iteration.
 
-    if "model_state_dict" in save_point:
-        state_dict = save_point["model_state_dict"]
+    Args:
+        fp: path of the checkpoint
+        device: device to load the model to
+        train: whether to load for continuing the training
+        model_class: class to build the model with, instead of the saved one
+        cache: whether to reuse the model of an earlier call for the same
+            checkpoint (and device and class), until the file changes. The
+            model is shared with all those calls, so a caller that changes
+            it (e.g. sets `p_s`) must not use the cache.
+
+    Returns:
+        the model, with train a tuple of the model, the optimizer state, the
+        scheduler state and the iteration
+    """
+    key = (path.abspath(fp), path.getmtime(fp), str(device), model_class)
+    if not train and cache and key in _MODELS:
+        return _MODELS[key]
 
-        if model_class is None:
-            model_class = save_point["params"]["__class__"]
-        args = save_point["params"]["args"]
-        kwargs = save_point["params"]["kwargs"].copy()
-        model = model_class(*args, **kwargs)
+    def build(params):
+        return (model_class or params["__class__"])(
+            *params["args"], **params["kwargs"].copy()
+        )
+
+    if path.exists(fp + PARAMS_SUFFIX):
+        # The model is built before its weights are read
+        params = load_params(fp)
+        model = build(params)
+        save_point = load_checkpoint(fp, device, optim=train)
+    else:
+        # Older checkpoints are read once, params and weights together
+        save_point = load_checkpoint(fp, device, optim=train)
+        params = save_point.get("params")
+        if params is not None:
+            model = build(params)
+
+    if params is not None:
+        state_dict = save_point["model_state_dict"]
 
         for k in filter(lambda x: x.startswith("p_s."), list(state_dict.keys())):
             del state_dict[k]
@@ -96,7 +422,10 @@ def load_model(
 
     if not train:
         model.eval()
-        return model.to(device)
+        model = model.to(device)
+        if cache:
+            _MODELS[key] = model
+        return model
 
     model.train()
     return (
@@ -108,21 +437,136 @@ def load_model(
 
 
 class FileLock(object):
-    def __init__(self, file_name):
-        self.path = Path(path.normpath(file_name) + ".lock")
+    def __init__(
+        self,
+        file_name: str,
+        timeout: Opt[float] = None,
+        stale: float = 3600.0,
+        poll: float = 0.01,
+    ):
+        """
+        Lock between processes, also on different hosts, for the file with
+        the given name. Uses `flock` on a lock file next to it, which the OS
+        releases when the holder dies. Where that is not supported (some
+        network file systems) a second lock file is created exclusively
+        instead and holds the host and pid of the owner, so that a lock left
+        behind by a dead process can be broken.
+
+        Args:
+            file_name: the file to lock
+            timeout: seconds to wait for the lock, None to wait forever
+            stale: age in seconds after which an exclusive lock file of
+                another host is taken as left behind
+            poll: first interval of retrying, it doubles up to a second
+        """
+        self.path = path.normpath(file_name) + ".lock"
+        # Apart from the flock file, which is left behind empty
+        self.exclusive_path = path.normpath(file_name) + ".xlock"
+        self.timeout, self.stale, self.poll = timeout, stale, poll
+        self._fd: Opt[int] = None
+        self._exclusive = False
+
+    def acquire(self):
+        start, wait = time.time(), self.poll
+        while not self._try_acquire():
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise TimeoutError(f"Could not lock {self.path} in {self.timeout}s")
+            # Backs off exponentially, with jitter against lockstep retries
+            time.sleep(wait * (0.5 + random()))
+            wait = min(2 * wait, 1.0)
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self._exclusive:
+            os.close(self._fd)
+            os.remove(self.exclusive_path)
+        else:
+            # The lock file is left in place, removing it would race with
+            # processes that just opened it
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
 
     def __enter__(self):
-        while self.path.exists():
-            print(f"{Fore.YELLOW}LockFile exists. Waiting…")
-            time.sleep(random())
-        time.sleep(random())
-        self.path.touch()
+        self.acquire()
+        return self
 
     def __exit__(self, *args):
-        if self.path.exists():
-            self.path.unlink()
+        self.release()
+
+    def _try_acquire(self) -> bool:
+        if fcntl is not None and not self._exclusive:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return True
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            except OSError:
+                # flock is not supported here
+                os.close(fd)
+                self._exclusive = True
+        try:
+            fd = os.open(self.exclusive_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            stale = self._stale_inode()
+            if stale is not None:
+                self._break(stale)
+            return False
+        os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+        self._fd, self._exclusive = fd, True
+        return True
+
+    def _break(self, inode: int):
+        """
+        Breaks the stale lock file with the given inode. It is renamed away
+        first, so of several waiters that found it stale only one removes it.
+        If another waiter was faster, the renamed file is its fresh lock and
+        is put back.
+        """
+        broken = f"{self.exclusive_path}.{socket.gethostname()}.{os.getpid()}"
+        try:
+            os.rename(self.exclusive_path, broken)
+        except FileNotFoundError:
+            return
+        if os.stat(broken).st_ino == inode:
+            print(f"{Fore.YELLOW}Breaking stale lock {self.exclusive_path}{Fore.RESET}")
         else:
-            print(f"{Fore.RED}Trying to delete not-existing FileLock{Fore.RESET}")
+            try:
+                os.link(broken, self.exclusive_path)
+            except FileExistsError:
+                pass
+        os.remove(broken)
+
+    def _stale_inode(self) -> Opt[int]:
+        """
+        The inode of the exclusive lock file if it was left behind, else None.
+        """
+        try:
+            stat = os.stat(self.exclusive_path)
+            with open(self.exclusive_path) as file:
+                content = file.read()
+        except OSError:
+            # Gone already
+            return None
+        age = time.time() - stat.st_mtime
+        try:
+            host, pid = content.split()
+        except ValueError:
+            # Either the owner is still writing it, or it died doing so
+            return stat.st_ino if age > self.stale else None
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return stat.st_ino
+            except PermissionError:
+                pass
+            return None
+        return stat.st_ino if age > self.stale else None
 
 
 def exit_prompt():
@@ -144,23 +588,6 @@ def vprint(*args):
     print(flush=True)
 
 
-def loadz(filename):
-    if Path(filename).exists():
-        return dict(np.load(filename))
-    else:
-        return dict()
-
-
-def appendz(filename, **kwargs):
-    npz = loadz(filename)
-    for key, value in kwargs.items():
-        if key in npz:
-            npz[key] = np.vstack((npz[key], value))
-        else:
-            npz[key] = value
-    np.savez(filename, **npz)
-
-
 def log_call(level=0):
     def wrapper(func):
         def wrapped(*args, **kwargs):
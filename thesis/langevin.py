@@ -1,34 +1,96 @@
-import torch
 from math import sqrt
+from typing import List, Optional, Sequence, Tuple
+
+import torch
 from torch import autograd
+from torch import Tensor as T
+
 
+class LangevinSampler(object):
+    def __init__(
+        self,
+        model,
+        σs: Sequence[float],
+        steps: int = 300,
+        η: float = 3e-5,
+        λ: float = 0.0,
+        n_sources: int = 4,
+        log_every: int = 50,
+        thin: Optional[int] = None,
+    ):
+        """
+        Annealed Langevin dynamics for the sources of a mix under a prior.
+        Any number of independent chains run as one batch. The chains only
+        sync with the host every `log_every` (and `thin`) steps.
 
-def langevin_sample(model, σ, m, ŝ=None):
-    N, C, L = m.shape
-    η = .00003 * (σ / .01)**2
-    # η *= 0.00001
-    λ = 1./σ**2
-    λ = 0
+        Args:
+            model: the prior, scored with `log_prob` if it has one
+            σs: the noise levels to anneal through, from high to low
+            steps: number of steps per noise level
+            η: step size at the last noise level, it scales with σ²
+            λ: weight of the constraint that the sources give the mix
+            n_sources: number of sources in the mix
+            log_every: interval of steps for logging the log-likelihood
+            thin: interval of steps for keeping the samples as trace,
+                None for no trace
+        """
+        self.model, self.σs, self.steps = model, list(σs), steps
+        self.η, self.λ, self.n_sources = η, λ, n_sources
+        self.log_every, self.thin = log_every, thin
 
-    δŝ = torch.zeros_like(ŝ)
+    def log_p(self, ŝ: T) -> T:
+        """
+        Log-likelihood per dimension of every chain [N].
+        """
+        if hasattr(self.model, "log_prob"):
+            log_p, log_det = self.model.log_prob(ŝ)
+            return (log_p + log_det).mean(-1)
+        return self.model(ŝ)[1].mean((1, 2))
 
-    _, L, _ = model(ŝ)
-    yield ŝ, L.mean(-1).squeeze().tolist(), δŝ
-    ŝ = (ŝ + 0.3 * torch.randn_like(ŝ))
+    def sample(
+        self, m: T, ŝ: Optional[T] = None, chains: int = 1
+    ) -> Tuple[T, List[Tuple[int, float, T]], Optional[T]]:
+        """
+        Args:
+            m: the mixes [N × C × L]
+            ŝ: initial sources [N × n_sources·C × L], random if None
+            chains: number of chains per mix
 
-    with torch.enable_grad():
+        Returns:
+            the final samples [N × chains × n_sources·C × L], the log as list
+            of (step, σ, log p [N × chains]) and the thinned trace
+            [T × N × chains × n_sources·C × L] if `thin` is set
+        """
+        N, C, L = m.shape
+        m = m.repeat_interleave(chains, 0)
         if ŝ is None:
-            ŝ = (0.1 * torch.randn((N, 4*C, L), device=m.device)).clamp(-1, 1)
-        ŝ.requires_grad = True
-        ℒ = 0
-        for i in range(300):
-            yield ŝ, ℒ, δŝ
-            _, ℒ, _ = model(ŝ)
-            δŝ = autograd.grad((ℒ.mean()), ŝ, only_inputs=True)[0]
-
-            # δŝ *= torch.tensor([1e3, 1e-1, 1e3, 1e3], device=δŝ.device).view(1, 4, 1)
-            ε = sqrt(2 * η) * torch.randn_like(ŝ)
-            m_ = (torch.stack(ŝ.chunk(4, 1), 0).sum(0) - m).repeat(1, 4, 1)
-            ŝ = ŝ.detach().add(η * (δŝ - λ * m_) + ε).clamp(-1, 1)
-            ℒ = list(map(lambda x: f"{x:.3}", ℒ.detach().cpu().mean(-1).squeeze().tolist()))
-    return ŝ, ℒ, δŝ
+            ŝ = 0.1 * torch.randn((N * chains, self.n_sources * C, L), device=m.device)
+            ŝ = ŝ.clamp(-1, 1)
+        else:
+            ŝ = ŝ.repeat_interleave(chains, 0)
+
+        log, trace, it = [], [], 0
+        with torch.enable_grad():
+            for σ in self.σs:
+                η = self.η * (σ / self.σs[-1]) ** 2
+                for _ in range(self.steps):
+                    ŝ.requires_grad_(True)
+                    log_p = self.log_p(ŝ)
+                    (δŝ,) = autograd.grad(log_p.sum(), ŝ, only_inputs=True)
+
+                    ŝ = ŝ.detach()
+                    if self.λ:
+                        m_ = torch.stack(ŝ.chunk(self.n_sources, 1), 0).mean(0) - m
+                        δŝ = δŝ - self.λ * m_.repeat(1, self.n_sources, 1)
+                    ε = sqrt(2 * η) * torch.randn_like(ŝ)
+                    ŝ = ŝ.add_(η * δŝ + ε).clamp_(-1, 1)
+
+                    if it % self.log_every == 0:
+                        log.append((it, σ, log_p.detach().view(N, chains).cpu()))
+                    if self.thin is not None and it % self.thin == 0:
+                        # A copy, the next steps update ŝ in place
+                        trace.append(ŝ.view(N, chains, -1, L).to("cpu", copy=True))
+                    it += 1
+
+        trace = torch.stack(trace) if trace else None
+        return ŝ.view(N, chains, -1, L), log, trace
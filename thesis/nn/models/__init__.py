@@ -1,6 +1,9 @@
+import time
 from abc import ABC
+from typing import Callable, List, Optional, Union
 
 import torch
+from colorama import Fore
 from torch import nn
 
 from ...utils import _LossLogger
@@ -17,3 +20,52 @@ class BaseModel(ABC, nn.Module):
 
     def infer(self, *args, **kwargs) -> torch.Tensor:
         pass
+
+
+def micro_batches(n: int, sample_bytes: int, memory_budget: Optional[int]) -> List[int]:
+    """
+    Sizes of the micro-batches to split n samples into, so that each batch
+    stays within the memory budget.
+
+    Args:
+        n: number of samples
+        sample_bytes: (estimated) memory one sample needs
+        memory_budget: memory per micro-batch in bytes, None for one batch
+
+    Returns:
+        the batch sizes
+    """
+    size = n if memory_budget is None else max(1, memory_budget // sample_bytes)
+    return [min(size, n - i) for i in range(0, n, size)]
+
+
+def reverse_batched(
+    reverse: Callable,
+    z: Union[torch.Tensor, List[torch.Tensor]],
+    sizes: List[int],
+    verbose: bool = False,
+) -> torch.Tensor:
+    """
+    Reverses the latents in micro-batches of the given sizes.
+
+    Args:
+        reverse: the reverse pass of a flow
+        z: the latents, or a list of latents per block [n × …]
+        sizes: sizes of the micro-batches, see `micro_batches`
+        verbose: whether to print the samples/s
+
+    Returns:
+        the reversed latents, concatenated
+    """
+    if isinstance(z, torch.Tensor):
+        parts = z.split(sizes)
+    else:
+        parts = [list(zs) for zs in zip(*[z_.split(sizes) for z_ in z])]
+    start = time.time()
+    samples = torch.cat([reverse(part) for part in parts])
+    if verbose:
+        if samples.is_cuda:
+            torch.cuda.synchronize(samples.device)
+        rate = sum(sizes) / (time.time() - start)
+        print(f"{Fore.YELLOW}Sampling with {Fore.GREEN}{rate:.1f}{Fore.YELLOW} samples/s{Fore.RESET}")
+    return samples
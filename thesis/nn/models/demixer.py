@@ -1,5 +1,5 @@
 from random import random
-from typing import Tuple
+from typing import Iterator, Tuple
 
 import torch
 from torch import Tensor as T
@@ -11,7 +11,7 @@ from . import BaseModel
 from ..modules import MelSpectrogram
 from ..wavenet import Wavenet
 from ...dist import AffineBeta
-from ...functional import normalize
+from ...functional import normalize, iter_chunked
 from ...utils import clean_init_args
 
 
@@ -58,6 +58,39 @@ class q_sǀm(nn.Module):
         q_s = AffineBeta(α, β)
         return q_s
 
+    def iter_chunked(
+        self, m: T, m_mel: T = None, size: int = 2 ** 16
+    ) -> Iterator[AffineBeta]:
+        """
+        Streams the posterior of a long mix in windows of `size` samples, see
+        `Wavenet.iter_chunked`. The mel spectrogram is upsampled only inside
+        the current window, the same as `forward` upsamples it.
+        """
+        L = m.shape[-1]
+        positions = torch.arange(L, device=m.device)
+
+        def window(m_w: T, idx: T) -> T:
+            c = None if m_mel is None else interpolate_window(m_mel, L, idx)
+            f = self.f(m_w, c)
+            return torch.cat((self.f_α(f), self.f_β(f)), dim=1) + 1e-4
+
+        for αβ in iter_chunked(window, m, positions, size=size, context=self.f.context):
+            α, β = αβ.chunk(2, dim=1)
+            yield AffineBeta(α, β)
+
+
+def interpolate_window(x: T, size: int, idx: T) -> T:
+    """
+    Positions `idx` of the linear interpolation of x to length `size`, the
+    same as `F.interpolate(x, size, mode="linear", align_corners=False)[..., idx]`.
+    """
+    L = x.shape[-1]
+    src = ((idx.to(x.dtype) + 0.5) * (L / size) - 0.5).clamp(min=0)
+    i0 = src.floor().long()
+    i1 = (i0 + 1).clamp(max=L - 1)
+    λ = src - i0.to(x.dtype)
+    return x[..., i0] * (1 - λ) + x[..., i1] * λ
+
 
 class Demixer(BaseModel):
     def __init__(
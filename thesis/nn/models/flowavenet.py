@@ -1,12 +1,13 @@
 from math import log
 from math import tau as τ
+from typing import Optional
 
 import torch
 from torch import nn
 from torch.nn import functional as F
 
-from . import BaseModel
-from ..modules import STFTUpsample
+from . import BaseModel, micro_batches, reverse_batched
+from ..modules import STFTUpsample, cached
 from ..wavenet import Wavenet
 from ...dist import norm_log_prob
 from ...functional import (
@@ -21,9 +22,10 @@ from ...utils import clean_init_args
 
 
 class ActNorm(nn.Module):
-    def __init__(self, in_channel, pretrained=False):
+    def __init__(self, in_channel, pretrained=False, groups=1):
         super().__init__()
 
+        self.groups = groups
         self.loc = nn.Parameter(torch.zeros(1, in_channel, 1))
         self.scale = nn.Parameter(torch.ones(1, in_channel, 1))
         self.initialized = pretrained
@@ -34,8 +36,8 @@ class ActNorm(nn.Module):
             mean = flatten.mean(1).unsqueeze(1).unsqueeze(2).permute(1, 0, 2)
             std = flatten.std(1).unsqueeze(1).unsqueeze(2).permute(1, 0, 2)
 
-            self.loc.data.copy_(-mean)
-            self.scale.data.copy_(1 / (std + 1e-6))
+            self.loc.copy_(-mean)
+            self.scale.copy_(1 / (std + 1e-6))
 
     def forward(self, x):
         if not self.initialized:
@@ -44,13 +46,16 @@ class ActNorm(nn.Module):
             self.initialized = True
 
         B, _, T = x.size()
-        log_abs = self.scale.abs().log()
-        log_det = torch.sum(log_abs) * B * T
+        log_abs = cached(self, "log_abs", self._log_abs, self.scale)
+        log_det = (log_abs * T).expand(B, -1)
 
         return self.scale * (x + self.loc), log_det
 
+    def _log_abs(self):
+        return self.scale.abs().log().view(self.groups, -1).sum(-1)
+
     def reverse(self, y):
-        return y / self.scale - self.loc
+        return y * cached(self, "inverse", self.scale.reciprocal, self.scale) - self.loc
 
 
 class AffineCoupling(nn.Module):
@@ -77,7 +82,14 @@ class AffineCoupling(nn.Module):
             bias=False,
         )
 
-    def forward(self, x, c=None):
+    def forward(self, x, c=None, swap=False):
+        """
+        Args:
+            x: input
+            c: conditional
+            swap: whether to put the transformed half first, which is the
+                same as flipping the output without the extra copy
+        """
         in_a, in_b = chunk(x, groups=self.groups)
 
         if c is not None:
@@ -86,12 +98,17 @@ class AffineCoupling(nn.Module):
         log_s, t = chunk(self.net(in_a, c), groups=self.groups)
 
         out_b = (in_b - t) * torch.exp(-log_s)
-        log_det = torch.sum(-log_s)
+        # The log-det is summed in fp32, also under autocast
+        log_det = -log_s.float().reshape(log_s.shape[0], self.groups, -1).sum(-1)
 
-        return interleave((in_a, out_b), groups=self.groups), log_det
+        out = (out_b, in_a) if swap else (in_a, out_b)
+        return interleave(out, groups=self.groups), log_det
 
-    def reverse(self, y, c=None):
-        out_a, out_b = chunk(y, groups=self.groups)
+    def reverse(self, y, c=None, swap=False):
+        if swap:
+            out_b, out_a = chunk(y, groups=self.groups)
+        else:
+            out_a, out_b = chunk(y, groups=self.groups)
 
         if c is not None:
             c, _ = chunk(c, groups=self.groups)
@@ -109,7 +126,7 @@ class Flow(nn.Module):
         super().__init__()
         self.groups = groups
 
-        self.actnorm = ActNorm(in_channel * groups)
+        self.actnorm = ActNorm(in_channel * groups, groups=groups)
         self.coupling = AffineCoupling(
             in_channel,
             width=width,
@@ -120,24 +137,21 @@ class Flow(nn.Module):
 
     def forward(self, x, c=None):
         out, log_det = self.actnorm(x)
-        out, log_det_c = self.coupling(out, c)
+        out, log_det_c = self.coupling(out, c, swap=True)
 
-        out = flip(out, groups=self.groups)
         if c is not None:
             c = flip(c, groups=self.groups)
 
         if log_det_c is not None:
-            log_det += log_det_c
+            log_det = log_det + log_det_c
 
         return out, c, log_det
 
     def reverse(self, out, c=None):
-        out = flip(out, groups=self.groups)
-
         if c is not None:
             c = flip(c, groups=self.groups)
 
-        x = self.coupling.reverse(out, c)
+        x = self.coupling.reverse(out, c, swap=True)
         x = self.actnorm.reverse(x)
         return x, c
 
@@ -247,6 +261,7 @@ class Flowavenet(BaseModel):
         self.params = clean_init_args(locals().copy())
         self.groups = groups
         self.block_per_split, self.n_block = block_per_split, n_block
+        self.in_channels, self.width = in_channel * groups, width
 
         if cin_channel is not None:
             self.c_up = STFTUpsample([16, 16])
@@ -271,12 +286,17 @@ class Flowavenet(BaseModel):
             if not split:
                 in_channel *= 2
 
-    def forward(self, x, c=None, _ce=True):
-        del _ce
-        N, C, L = x.size()
+    def _flow(self, x, c=None):
+        """
+        Passes the signal through all blocks.
+
+        Returns:
+            log-det per sample and group [N × groups], the log p of all
+            latents and all latents (split off and final)
+        """
         out = x
         if c is not None:
-            c = self.c_up(c, L)
+            c = self.c_up(c, x.shape[-1])
 
         log_det = 0
         log_p_list, z_list = [], []
@@ -290,6 +310,12 @@ class Flowavenet(BaseModel):
         z_list.append(out)
         log_p_out = -0.5 * (log(τ) + out.pow(2))
         log_p_list.append(log_p_out)
+        return log_det, log_p_list, z_list
+
+    def forward(self, x, c=None, _ce=True):
+        del _ce
+        N, C, L = x.size()
+        log_det, log_p_list, z_list = self._flow(x, c)
 
         for i in range(len(log_p_list)):
             _log_p = log_p_list[i].mean((0, -1)).view(self.groups, -1).mean(-1)
@@ -299,10 +325,30 @@ class Flowavenet(BaseModel):
         log_p = self.combine_z_list(log_p_list)
         z = self.combine_z_list(z_list)
 
-        log_det = log_det / (N * C * L)
+        log_det = log_det.sum() / (N * C * L)
 
         return z, log_p, log_det
 
+    def log_prob(self, x, c=None):
+        """
+        Exact log-likelihood of every sample, without logging to ℒ and without
+        re-assembling z, so nothing is synced with the host. Both terms are
+        averaged over the dimensions of one group, their sum is the log
+        p(x) per dimension.
+
+        Args:
+            x: the signal [N × C × L]
+            c: the conditional
+
+        Returns:
+            log p [N × groups], log det [N × groups]
+        """
+        N, C, L = x.size()
+        log_det, log_p_list, _ = self._flow(x, c)
+        log_p = sum(lp.reshape(N, self.groups, -1).sum(-1) for lp in log_p_list)
+        n = C // self.groups * L
+        return log_p / n, log_det / n
+
     def combine_z_list(self, z_list):
         for i in reversed(range(self.n_block)):
             if not ((i + 1) % self.block_per_split or i == self.n_block - 1):
@@ -338,6 +384,47 @@ class Flowavenet(BaseModel):
                 x, c = block.reverse(x, c)
         return x
 
+    @torch.no_grad()
+    def sample(
+        self,
+        n: int,
+        length: int,
+        temperature: float = 1.0,
+        memory_budget: int = None,
+        z: Optional[torch.Tensor] = None,
+        verbose: bool = False,
+    ) -> torch.Tensor:
+        """
+        Draws samples from the prior by reversing Gaussian noise.
+
+        Args:
+            n: number of samples
+            length: length of the samples, a multiple of 2^n_block
+            temperature: standard deviation of the noise
+            memory_budget: bytes one micro-batch may use, None for one batch
+            z: latents to reverse instead of the noise [n × C × length]
+            verbose: whether to print the samples/s
+
+        Returns:
+            the samples [n × C × length]
+        """
+        if length % 2 ** self.n_block:
+            raise ValueError(f"length has to be a multiple of {2 ** self.n_block}")
+        device = next(self.parameters()).device
+        if z is None:
+            z = temperature * torch.randn((n, self.in_channels, length), device=device)
+        elif z.shape != (n, self.in_channels, length):
+            raise ValueError(f"z of shape {tuple(z.shape)} does not fit n and length")
+        sizes = micro_batches(n, self.sample_bytes(length), memory_budget)
+        return reverse_batched(self.reverse, z, sizes, verbose)
+
+    def sample_bytes(self, length: int) -> int:
+        """
+        Rough memory of reversing one sample: the signal and the activations
+        of the coupling WaveNets, which are largest in the first block.
+        """
+        return 4 * length * (2 * self.in_channels + 3 * self.width * self.groups)
+
     def test(self, x):
         if x.dim() > 3:
             x = x.flatten(1, 2)
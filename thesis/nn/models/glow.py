@@ -1,15 +1,21 @@
+from typing import List, Optional, Tuple
+
 import torch
 from torch import Tensor as T
 from torch import nn
 
-from . import BaseModel
-from ..modules import ZeroConv2d
+from . import BaseModel, micro_batches, reverse_batched
+from ..modules import ZeroConv2d, cached
 from ...dist import norm_log_prob
-from ...functional import chunk, interleave, flip
+from ...functional import chunk, interleave
 from ...setup import DEFAULT
 from ...utils import clean_init_args
 
 
+def gaussian_sample(eps: T, mean: T, log_sd: T) -> T:
+    return mean + torch.exp(log_sd) * eps
+
+
 class ActNorm(nn.Module):
     def __init__(self, in_channel, pretrained=False):
         super().__init__()
@@ -36,22 +42,26 @@ class ActNorm(nn.Module):
                 .permute(1, 0, 2, 3)
             )
 
-            self.loc.data.copy_(-mean)
-            self.scale.data.copy_(1 / (std + 1e-6))
+            self.loc.copy_(-mean)
+            self.scale.copy_(1 / (std + 1e-6))
 
     def forward(self, x: T):
         if not self.initialized:
             if self.training:
                 self.initialize(x)
+            self.initialized = True
 
         _, _, H, W = x.shape
-        log_abs = self.scale.abs().log()
-        log_det = torch.sum(log_abs) * H * W
+        log_abs = cached(self, "log_abs", self._log_abs, self.scale)
+        log_det = log_abs * H * W
 
         return self.scale * (x + self.loc), log_det
 
+    def _log_abs(self):
+        return torch.sum(self.scale.abs().log())
+
     def reverse(self, y):
-        return y / self.scale - self.loc
+        return y * cached(self, "inverse", self.scale.reciprocal, self.scale) - self.loc
 
 
 class AffineCoupling(nn.Module):
@@ -74,19 +84,25 @@ class AffineCoupling(nn.Module):
         self.net[2].weight.data.normal_(0, 0.05)
         self.net[2].bias.data.zero_()
 
-    def forward(self, x: T):
+    def forward(self, x: T, swap: bool = False):
         in_a, in_b = chunk(x, groups=self.groups)
 
         log_s, t = chunk(self.net(in_a), groups=self.groups)
         s = torch.sigmoid(log_s + 2)
         out_b = (in_b + t) * s
 
-        log_det = s.log().view(x.shape[0], -1).sum(1)
+        # The log-det is summed in fp32, also under autocast
+        log_det = s.float().log().reshape(x.shape[0], -1).sum(1)
 
-        return interleave((in_a, out_b), groups=self.groups), log_det
+        # Swapping the halves flips the output without the extra copy
+        out = (out_b, in_a) if swap else (in_a, out_b)
+        return interleave(out, groups=self.groups), log_det
 
-    def reverse(self, y):
-        out_a, out_b = chunk(y, groups=self.groups)
+    def reverse(self, y: T, swap: bool = False):
+        if swap:
+            out_b, out_a = chunk(y, groups=self.groups)
+        else:
+            out_a, out_b = chunk(y, groups=self.groups)
 
         log_s, t = chunk(self.net(out_a), groups=self.groups)
         s = torch.sigmoid(log_s + 2)
@@ -96,20 +112,19 @@ class AffineCoupling(nn.Module):
 
 
 class Flow(nn.Module):
-    def __init__(self, in_channel, groups=1):
+    def __init__(self, in_channel, groups=1, width=512):
         super().__init__()
 
         self.groups = groups
 
         self.actnorm = ActNorm(in_channel)
         # self.invconv = InvConv2d(in_channel)
-        self.coupling = AffineCoupling(in_channel, groups=groups)
+        self.coupling = AffineCoupling(in_channel, filter_size=width, groups=groups)
 
     def forward(self, x):
         out, log_det = self.actnorm(x)
         # out, det1 = self.invconv(out)
-        out, det2 = self.coupling(out)
-        out = flip(out, groups=self.groups)
+        out, det2 = self.coupling(out, swap=True)
 
         log_det = log_det
         if det2 is not None:
@@ -118,15 +133,14 @@ class Flow(nn.Module):
         return out, log_det
 
     def reverse(self, y):
-        y = flip(y, groups=self.groups)
-        x = self.coupling.reverse(y)
+        x = self.coupling.reverse(y, swap=True)
         # x = self.invconv.reverse(x)
         x = self.actnorm.reverse(x)
         return x
 
 
 class Block(nn.Module):
-    def __init__(self, in_channel, n_flow, split=True, groups=1):
+    def __init__(self, in_channel, n_flow, split=True, groups=1, width=512):
         super().__init__()
 
         squeeze_dim = in_channel * 4
@@ -134,7 +148,7 @@ class Block(nn.Module):
 
         self.flows = nn.ModuleList()
         for i in range(n_flow):
-            self.flows.append(Flow(squeeze_dim, groups=groups))
+            self.flows.append(Flow(squeeze_dim, groups=groups, width=width))
 
         self.split = split
 
@@ -173,7 +187,7 @@ class Block(nn.Module):
 
         if reconstruct:
             if self.split:
-                x = torch.cat([y, eps], 1)
+                x = interleave((y, eps), groups=self.groups)
 
             else:
                 x = eps
@@ -182,7 +196,7 @@ class Block(nn.Module):
             if self.split:
                 mean, log_sd = self.prior(x).chunk(2, 1)
                 z = gaussian_sample(eps, mean, log_sd)
-                x = torch.cat([y, z], 1)
+                x = interleave((y, z), groups=self.groups)
 
             else:
                 zero = torch.zeros_like(x)
@@ -206,17 +220,20 @@ class Block(nn.Module):
 
 
 class Glow(BaseModel):
-    def __init__(self, in_channel, n_flow, n_block, groups=1, **kwargs):
+    def __init__(self, in_channel, n_flow, n_block, groups=1, width=512, **kwargs):
         super().__init__(**kwargs)
         self.params = clean_init_args(locals().copy())
 
         self.blocks = nn.ModuleList()
         self.n_blocks, self.groups = n_block, groups
+        self.in_channel, self.width = in_channel, width
         n_channel = in_channel
         for i in range(n_block - 1):
-            self.blocks.append(Block(n_channel, n_flow, groups=groups))
+            self.blocks.append(Block(n_channel, n_flow, groups=groups, width=width))
             n_channel *= 2
-        self.blocks.append(Block(n_channel, n_flow, split=False, groups=groups))
+        self.blocks.append(
+            Block(n_channel, n_flow, split=False, groups=groups, width=width)
+        )
 
     def forward(self, x):
         out = x
@@ -257,18 +274,17 @@ class Glow(BaseModel):
         )
         return z
 
-    @staticmethod
-    def test(model, x: T, LL):
+    def test(self, x: T):
         n_pix = (x.shape[-1] * x.shape[-2])
-        _, log_p, log_det = model.forward(x)
+        _, log_p, log_det = self.forward(x)
 
-        LL.log_det = -torch.mean(log_det) / n_pix
-        ℒ = LL.log_det
+        self.ℒ.log_det = -torch.mean(log_det) / n_pix
+        ℒ = self.ℒ.log_det
 
         log_p = -log_p.mean((0, 2, 3))
         for k in range(x.shape[1]):
             ℒ += log_p[k]
-            setattr(LL, f"log_p/{DEFAULT.signals[k]}", log_p[k])
+            setattr(self.ℒ, f"log_p/{DEFAULT.signals[k]}", log_p[k])
         return ℒ
 
     def reverse(self, z_list, reconstruct=False):
@@ -279,3 +295,52 @@ class Glow(BaseModel):
             else:
                 x = block.reverse(x, z_list[-(i + 1)], reconstruct=reconstruct)
         return x
+
+    def z_shapes(self, height: int, width: int) -> List[Tuple[int, int, int]]:
+        """
+        Shapes of the latents of every block for an input of the given size.
+        """
+        shapes, C = [], self.in_channel
+        for i in range(1, self.n_blocks):
+            shapes.append((C * 2 ** i, height // 2 ** i, width // 2 ** i))
+        n = self.n_blocks
+        shapes.append((C * 2 ** (n + 1), height // 2 ** n, width // 2 ** n))
+        return shapes
+
+    @torch.no_grad()
+    def sample(
+        self,
+        n: int,
+        length: int,
+        temperature: float = 1.0,
+        memory_budget: int = None,
+        height: int = 80,
+        z: Optional[List[T]] = None,
+        verbose: bool = False,
+    ) -> T:
+        """
+        Draws samples from the prior by reversing Gaussian noise.
+
+        Args:
+            n: number of samples
+            length: width (time frames) of the samples
+            temperature: standard deviation of the noise
+            memory_budget: bytes one micro-batch may use, None for one batch
+            height: height (mel bins) of the samples
+            z: latents of every block to reverse instead of the noise
+            verbose: whether to print the samples/s
+
+        Returns:
+            the samples [n × C × height × length]
+        """
+        if length % 2 ** self.n_blocks or height % 2 ** self.n_blocks:
+            raise ValueError(f"Sizes have to be multiples of {2 ** self.n_blocks}")
+        device = next(self.parameters()).device
+        shapes = self.z_shapes(height, length)
+        if z is None:
+            z = [temperature * torch.randn((n, *shape), device=device) for shape in shapes]
+        elif [tuple(z_.shape) for z_ in z] != [(n, *shape) for shape in shapes]:
+            raise ValueError("z does not fit n, length and height")
+        sample_bytes = 4 * height * length * (2 * self.in_channel + self.width // 2)
+        sizes = micro_batches(n, sample_bytes, memory_budget)
+        return reverse_batched(self.reverse, z, sizes, verbose)
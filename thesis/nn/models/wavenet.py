@@ -1,8 +1,9 @@
+import torch
 from torch import nn
 from . import BaseModel
 from ..wavenet import Wavenet as WaveNetModule
 from ...utils import clean_init_args
-from ...audio import encode_μ_law
+from ...audio import encode_μ_law, decode_μ_law
 from torch.nn import functional as F
 
 
@@ -45,3 +46,29 @@ class WaveNet(BaseModel):
             setattr(self.ℒ, f"CE_{i}", F.cross_entropy(ŝ[:, i*256:(i+1)*256, :], s[:, i, 1:].long()))
             ℒ = ℒ + getattr(self.ℒ, f"CE_{i}")
         return ℒ
+
+    @torch.no_grad()
+    def sample(self, n: int, length: int, temperature: float = 1.0) -> torch.Tensor:
+        """
+        Samples from the autoregressive prior, one time step at a time with
+        the queued incremental forward of the WaveNet.
+
+        Args:
+            n: number of samples
+            length: number of time steps
+            temperature: temperature of the softmax over the classes
+
+        Returns:
+            the decoded samples [n × in_channels × length]
+        """
+        wavenet, device = self.net[0], next(self.parameters()).device
+        wavenet.clear_queues(n)
+        # Start from silence
+        x = encode_μ_law(torch.zeros(n, self.in_channels, 1, device=device))
+        out = torch.empty(n, self.in_channels, length, device=device)
+        for t in range(length):
+            ŝ = self.net[1](wavenet.step(x))
+            probs = F.softmax(ŝ.view(n * self.in_channels, -1) / temperature, -1)
+            x = torch.multinomial(probs, 1).view(n, self.in_channels, 1).float()
+            out[..., t] = x[..., 0]
+        return decode_μ_law(out)
@@ -1,9 +1,10 @@
-from typing import List
+from typing import Callable, List, Tuple
 
+import numpy as np
 import torch
+from scipy import linalg
 from torch import Tensor as T
 from torch import nn
-from torch.autograd import Variable
 from torch.nn import functional as F
 from torchaudio.transforms import MelSpectrogram as _MelSpectrogram
 
@@ -44,30 +45,164 @@ class Conv1d(nn.Module):
             y = y[:, :, : -self.padding]
         return y
 
+    @property
+    def context(self) -> Tuple[int, int]:
+        """
+        Number of past and future input samples one output sample depends on.
+        """
+        width = self.conv.dilation[0] * (self.conv.kernel_size[0] - 1)
+        return (width, 0) if self.causal else (self.padding, width - self.padding)
+
+    def clear_queue(self, n: int):
+        """
+        Starts incremental generation with `step` for a batch of n. The queue
+        holds the past inputs the dilated kernel reaches, zeros at the start
+        like the padding.
+        """
+        if not self.causal:
+            raise ValueError("Only a causal convolution can be stepped")
+        self.queue = self.conv.weight_v.new_zeros(
+            n, self.conv.in_channels, self.padding
+        )
+        self.t = 0
+        self.step_weights = step_weights(self.conv)
+
+    def step(self, x: T) -> T:
+        """
+        Output for the current time step from its input [N×C×1] and the queue
+        of past inputs, the same as the last step of `forward`.
+        """
+        k, d = self.conv.kernel_size[0], self.conv.dilation[0]
+        if self.padding:
+            past = [(self.t - m * d) % self.padding for m in range(k - 1, 0, -1)]
+            taps = torch.cat((self.queue[..., past], x), -1)
+            self.queue[..., self.t % self.padding] = x[..., 0]
+        else:
+            taps = x
+        self.t += 1
+        return step_conv(taps, *self.step_weights)
+
+
+def step_weights(conv: nn.Conv1d):
+    """
+    Weight and bias of a (weight normed) convolution laid out for `step_conv`.
+    weight_norm only updates the weight in forward, so it is computed here.
+    """
+    if hasattr(conv, "weight_v"):
+        v, g = conv.weight_v, conv.weight_g
+        weight = v * (g / v.norm(dim=(1, 2), keepdim=True))
+    else:
+        weight = conv.weight
+    groups, out_channels = conv.groups, conv.out_channels
+    weight = weight.reshape(groups, out_channels // groups, -1).transpose(1, 2)
+    bias = conv.bias if conv.bias is not None else weight.new_zeros(out_channels)
+    return weight.contiguous(), bias.view(groups, 1, -1)
+
+
+def step_conv(taps: T, weight: T, bias: T) -> T:
+    """
+    Applies a convolution to exactly one kernel width of input [N×C×k]. A
+    batched matmul over the groups is a lot faster than conv1d for one step.
+    """
+    N, groups = taps.shape[0], weight.shape[0]
+    y = torch.baddbmm(bias, taps.reshape(N, groups, -1).transpose(0, 1), weight)
+    return y.transpose(0, 1).reshape(N, -1, 1)
+
+
+def cached(module: nn.Module, name: str, compute: Callable[[], T], *params: T) -> T:
+    """
+    Result of `compute`, kept on the module until one of the parameters
+    changes. Changes are noticed through the version counter that every
+    in-place update (optimizer step, load_state_dict, …) bumps, and through
+    the storage moving (`.to()`). While autograd records through the
+    parameters nothing is cached, as the result would hold the graph.
+
+    Args:
+        module: module to keep the result on
+        name: name of the cached value
+        compute: computes the value
+        params: the parameters the value depends on
+
+    Returns:
+        the (cached) value
+    """
+    if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+        return compute()
+    key = tuple((p.data_ptr(), p._version) for p in params)
+    cache = module.__dict__.setdefault("_cached", {})
+    if name not in cache or cache[name][0] != key:
+        cache[name] = (key, compute())
+    return cache[name][1]
+
 
 class InvConv2d(nn.Module):
     def __init__(self, in_channel):
         super().__init__()
 
-        weight = torch.randn(in_channel, in_channel)
-        q, _ = torch.qr(weight)
-        weight = q.unsqueeze(2).unsqueeze(3)
+        q, _ = linalg.qr(np.random.randn(in_channel, in_channel))
+        weight = torch.from_numpy(q.astype(np.float32)).unsqueeze(2).unsqueeze(3)
         self.weight = nn.Parameter(weight)
 
     def forward(self, x: T):
         _, _, H, W = x.shape
 
         y = F.conv2d(x, self.weight)
-        log_det = (
-            H * W * torch.slogdet(self.weight.squeeze().double())[1].float()
-        )
+        log_det = H * W * cached(self, "log_det", self._log_det, self.weight)
 
         return y, log_det
 
     def reverse(self, y):
-        return F.conv2d(
-            y, self.weight.squeeze().inverse().unsqueeze(2).unsqueeze(3)
-        )
+        return F.conv2d(y, cached(self, "inverse", self._inverse, self.weight))
+
+    def _log_det(self):
+        return torch.slogdet(self.weight.squeeze().double())[1].float()
+
+    def _inverse(self):
+        return self.weight.squeeze().inverse().unsqueeze(2).unsqueeze(3)
+
+
+class InvConv2dLU(nn.Module):
+    def __init__(self, in_channel):
+        """
+        Invertible 1×1 convolution with the weight parametrized by its LU
+        decomposition W = P·L·(U + diag(s)), so the log-det is just Σ log|s|.
+        """
+        super(InvConv2dLU, self).__init__()
+
+        q, _ = linalg.qr(np.random.randn(in_channel, in_channel))
+        p, lower, upper = (w.astype(np.float32) for w in linalg.lu(q))
+        s = np.diag(upper)
+
+        self.register_buffer("p", torch.from_numpy(p))
+        self.register_buffer("sign_s", torch.from_numpy(np.sign(s)))
+        self.register_buffer("l_mask", torch.tril(torch.ones(in_channel, in_channel), -1))
+        self.register_buffer("eye", torch.eye(in_channel))
+        self.lower = nn.Parameter(torch.from_numpy(lower))
+        self.upper = nn.Parameter(torch.from_numpy(np.triu(upper, 1)))
+        self.log_s = nn.Parameter(torch.from_numpy(np.log(np.abs(s))))
+
+    def forward(self, x: T):
+        _, _, H, W = x.shape
+
+        weight = cached(self, "weight", self._weight, *self._params)
+        log_det = H * W * torch.sum(self.log_s)
+
+        return F.conv2d(x, weight), log_det
+
+    def reverse(self, y):
+        return F.conv2d(y, cached(self, "inverse", self._inverse, *self._params))
+
+    @property
+    def _params(self):
+        return self.lower, self.upper, self.log_s
+
+    def _weight(self):
+        lower = self.lower * self.l_mask + self.eye
+        upper = self.upper * self.l_mask.T + torch.diag(self.sign_s * torch.exp(self.log_s))
+        return (self.p @ lower @ upper).unsqueeze(2).unsqueeze(3)
+
+    def _inverse(self):
+        return self._weight().squeeze().inverse().unsqueeze(2).unsqueeze(3)
 
 
 class ZeroConv1d(nn.Module):
@@ -106,18 +241,16 @@ class LinearInvert(nn.Linear):
         super(LinearInvert, self).__init__(
             in_features=in_features, out_features=out_features, bias=True
         )
-        self.inv_weights = None
         # I cannot init the weights to be orthonormal as they're not gonna be
         # square. :((((((
-        self.weight.normal_()
-        self.bias.normal_()
+        with torch.no_grad():
+            self.weight.normal_()
+            self.bias.normal_()
 
     def forward(self, x: torch.Tensor, reverse: bool = False) -> torch.Tensor:
         if reverse:
-            if self.inv_weights is None:
-                inv_w = self.weight.type(x.dtype).inverse()
-                self.inv_weights = Variable(inv_w.unsqueeze(-1))
-            y = F.linear(x - self.bias, self.inv_weights, None)
+            inv_weight = cached(self, "inverse", self.weight.inverse, self.weight)
+            y = F.linear(x - self.bias, inv_weight.type(x.dtype), None)
             return y
         else:
             y = super(LinearInvert, self).forward(x)
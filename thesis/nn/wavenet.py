@@ -1,12 +1,13 @@
 import math
-from typing import Optional as Opt
+from typing import Iterator, Tuple, Optional as Opt
 from functools import partial
 
 import torch
 from torch import nn
 from torch.nn.utils import weight_norm
 
-from .modules import Conv1d, ZeroConv1d
+from .modules import Conv1d, ZeroConv1d, step_weights, step_conv
+from ..functional import iter_chunked
 
 
 class GatedResBlock(nn.Module):
@@ -56,15 +57,35 @@ class GatedResBlock(nn.Module):
     def forward(self, tensor, c=None):
         h_filter = self.filter_conv(tensor)
         h_gate = self.gate_conv(tensor)
-
+        return self._gate(tensor, h_filter, h_gate, c)
+
+    def clear_queue(self, n: int):
+        self.filter_conv.clear_queue(n)
+        self.gate_conv.clear_queue(n)
+        self.step_res = step_weights(self.res_conv)
+        self.step_skip = step_weights(self.skip_conv) if self.skip else None
+
+    def step(self, tensor, c=None):
+        """
+        Incremental forward of a single time step [N×C×1], see `Conv1d.step`.
+        """
+        h_filter = self.filter_conv.step(tensor)
+        h_gate = self.gate_conv.step(tensor)
+        return self._gate(tensor, h_filter, h_gate, c, step=True)
+
+    def _gate(self, tensor, h_filter, h_gate, c=None, step=False):
         if self.conditioned:
             h_filter += self.filter_conv_c(c)
             h_gate += self.gate_conv_c(c)
 
         out = torch.tanh(h_filter) * torch.sigmoid(h_gate)
 
-        res = self.res_conv(out)
-        skip = self.skip_conv(out) if self.skip else None
+        if step:
+            res = step_conv(out, *self.step_res)
+            skip = step_conv(out, *self.step_skip) if self.skip else None
+        else:
+            res = self.res_conv(out)
+            skip = self.skip_conv(out) if self.skip else None
         return (tensor + res) * math.sqrt(0.5), skip
 
 
@@ -91,7 +112,9 @@ class Wavenet(nn.Module):
 
         self.skip = skip_channels is not None
 
-        self.init = Conv1d(in_channels, residual_channels, 3, bias=bias, groups=groups)
+        self.init = Conv1d(
+            in_channels, residual_channels, 3, causal=causal, bias=bias, groups=groups
+        )
 
         self.res_blocks = nn.ModuleList()
         for b in range(n_blocks):
@@ -113,11 +136,13 @@ class Wavenet(nn.Module):
         last_channels = skip_channels if self.skip else residual_channels
         fc_channels = last_channels if fc_channels is None else fc_channels
 
-        last_layer = ZeroConv1d if zero_final else partial(Conv1d, kernel_size=fc_kernel_size, bias=bias)
+        last_layer = ZeroConv1d if zero_final else partial(
+            Conv1d, kernel_size=fc_kernel_size, causal=causal, bias=bias
+        )
 
         self.final = nn.Sequential(
             nn.ReLU(),
-            Conv1d(last_channels, fc_channels, groups=groups),
+            Conv1d(last_channels, fc_channels, causal=causal, groups=groups),
             nn.ReLU(),
             last_layer(fc_channels, out_channels, groups=groups),
         )
@@ -137,6 +162,59 @@ class Wavenet(nn.Module):
             out = self.final(h)
         return out
 
+    @property
+    def context(self) -> Tuple[int, int]:
+        """
+        Number of past and future input samples one output sample depends on.
+        """
+        # Filter and gate conv of a block see the same samples
+        convs = [self.init] + [block.filter_conv for block in self.res_blocks]
+        convs += [layer for layer in self.final if isinstance(layer, Conv1d)]
+        return sum(c.context[0] for c in convs), sum(c.context[1] for c in convs)
+
+    @property
+    def receptive_field(self) -> int:
+        return sum(self.context) + 1
+
+    def iter_chunked(
+        self, x: torch.Tensor, c: Opt[torch.Tensor] = None, size: int = 2 ** 16
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streams the output for a long input in windows of `size` samples, each
+        with the receptive field as overlap, so that the pieces are exactly
+        the output of `forward` on the whole input.
+        """
+        yield from iter_chunked(self, x, c, size=size, context=self.context)
+
+    def clear_queues(self, n: int):
+        """
+        Starts incremental generation with `step` for a batch of n (only for
+        causal nets).
+        """
+        self.init.clear_queue(n)
+        for block in self.res_blocks:
+            block.clear_queue(n)
+        for layer in self.final:
+            if isinstance(layer, Conv1d):
+                layer.clear_queue(n)
+
+    def step(self, x: torch.Tensor, c: Opt[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Output for a single time step [N×C×1] given the queues of all earlier
+        steps (Fast WaveNet). Costs one kernel application per layer instead
+        of running over the whole past.
+        """
+        h = self.init.step(x)
+        skip = 0
+        for block in self.res_blocks:
+            h, s = block.step(h, c)
+            if self.skip:
+                skip += s
+        out = skip if self.skip else h
+        for layer in self.final:
+            out = layer.step(out) if isinstance(layer, Conv1d) else layer(out)
+        return out
+
     def check_for_nans(self):
         for i, b in enumerate(self.res_blocks):
             convs = [b.gate_conv.conv, b.filter_conv.conv, b.res_conv, b.skip_conv, b.gate_conv_c, b.filter_conv_c]
@@ -0,0 +1,83 @@
+import os
+import time
+from glob import glob
+from os import path
+from typing import List
+
+import numpy as np
+
+from .io import FileLock
+
+
+class ResultStore(object):
+    def __init__(self, folder: str):
+        """
+        Append-only store of result arrays. Every append writes one new chunk
+        file per key, named by the time and the process, so appending never
+        rewrites earlier results and concurrent jobs do not clobber each
+        other. Reading a key gives all its chunks stacked, in the order they
+        were appended. Every append is one row, so a key holds
+        [appends × …], the value is not concatenated to the earlier ones.
+
+        Args:
+            folder: directory of the store, one subdirectory per key
+        """
+        self.folder = folder
+
+    def append(self, **values):
+        """
+        Appends every value as one row of its key.
+        """
+        stamp = f"{time.time_ns():020d}-{os.getpid()}"
+        for key, value in values.items():
+            self._write(key, f"{stamp}.npy", np.asarray(value)[None])
+
+    def keys(self) -> List[str]:
+        if not path.isdir(self.folder):
+            return []
+        return sorted(
+            key for key in os.listdir(self.folder) if self._chunks(key)
+        )
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self._chunks(key))
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        """
+        All rows of the key [rows × …]. The chunks are memory-mapped, only
+        the stacked result is read into memory. Reads under the lock of the
+        key, so they never see a merged chunk together with its parts.
+        """
+        if key not in self:
+            raise KeyError(key)
+        with FileLock(path.join(self.folder, key)):
+            chunks = self._chunks(key)
+            return np.concatenate([np.load(fp, mmap_mode="r") for fp in chunks])
+
+    def compact(self, key: str):
+        """
+        Merges the chunks of the key into one, for faster reads. Chunks that
+        are appended meanwhile are left as they are. Compacting and reading
+        take the lock of the key, appending does not need it.
+        """
+        with FileLock(path.join(self.folder, key)):
+            chunks = self._chunks(key)
+            if len(chunks) < 2:
+                return
+            # Named after the last merged chunk, so the order stays the same
+            name = path.basename(chunks[-1])[: -len(".npy")] + "-merged.npy"
+            self._write(key, name, np.concatenate([np.load(fp) for fp in chunks]))
+            for fp in chunks:
+                os.remove(fp)
+
+    def _chunks(self, key: str) -> List[str]:
+        return sorted(glob(path.join(self.folder, key, "*.npy")))
+
+    def _write(self, key: str, name: str, rows: np.ndarray):
+        folder = path.join(self.folder, key)
+        os.makedirs(folder, exist_ok=True)
+        # Written under a temporary name, readers only see complete chunks
+        tmp = path.join(folder, f".{name}.tmp")
+        with open(tmp, "wb") as file:
+            np.save(file, rows)
+        os.replace(tmp, path.join(folder, name))
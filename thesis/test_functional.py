@@ -25,3 +25,363 @@ def test_shift1d():
         assert y.shape == x.shape
         assert torch.all(y[:, :, : length - shift] == x[:, :, shift:])
         assert y.is_contiguous()
+
+
+def test_oscillators():
+    import numpy as np
+    from .audio import oscillator, oscillators
+
+    shapes = ["sin", "square", "saw", "triangle", "halfsin", "reversesaw"]
+    ν = np.array([[13, 50, 97, 340, 64, 1000]])
+    φ = np.array([[0, 5, 97, 170, 31, 999]])
+    y = oscillators(3000, shapes, ν, φ)
+    assert y.shape == (1, len(shapes), 3000)
+    for k, shape in enumerate(shapes):
+        x = oscillator(3000, shape, ν[0, k], φ[0, k])[0]
+        # scipy can flip single samples on (half) period boundaries
+        wrong = np.nonzero(np.abs(x - y[0, k]) > 1e-5)[0]
+        assert np.all(2 * (wrong + φ[0, k]) % ν[0, k] == 0)
+
+
+def test_chunk_interleave_flip():
+    from .functional import chunk, interleave, flip
+
+    # Channels of 2 groups with 2 chunks of 2 channels each
+    x = torch.arange(8)[None, :, None].repeat(3, 1, 5).float()
+    a, b = chunk(x, groups=2)
+    assert torch.equal(a[0, :, 0], torch.tensor([0.0, 1, 4, 5]))
+    assert torch.equal(b[0, :, 0], torch.tensor([2.0, 3, 6, 7]))
+    assert torch.equal(interleave((a, b), groups=2), x)
+    assert torch.equal(flip(x, groups=2), interleave((b, a), groups=2))
+    assert torch.equal(flip(flip(x, groups=2), groups=2), x)
+    y = torch.randn(3, 5, 8)
+    a, b = chunk(y, groups=2, dim=-1)
+    assert a.shape == (3, 5, 4)
+    assert torch.equal(interleave((a, b), groups=2, dim=-1), y)
+
+
+def test_wavenet_step():
+    from .nn.wavenet import Wavenet
+
+    net = Wavenet(
+        in_channels=2, out_channels=6, n_blocks=2, n_layers=3, residual_channels=8,
+        gate_channels=8, skip_channels=8, cin_channels=None, causal=True, groups=2,
+    )
+    x = torch.randn(3, 2, 20)
+    with torch.no_grad():
+        y = net(x)
+        net.clear_queues(3)
+        ŷ = torch.cat([net.step(x[..., t : t + 1]) for t in range(20)], -1)
+    assert torch.allclose(y, ŷ, atol=1e-5)
+
+
+def test_wavenet_chunked():
+    from .nn.wavenet import Wavenet
+
+    for causal in [False, True]:
+        net = Wavenet(
+            in_channels=2, out_channels=4, n_blocks=2, n_layers=4, residual_channels=8,
+            gate_channels=8, skip_channels=8, cin_channels=3, causal=causal,
+        )
+        assert net.receptive_field == 1 + 2 + 2 * (2 + 4 + 8 + 16) + 2
+        x, c = torch.randn(2, 2, 500), torch.randn(2, 3, 500)
+        with torch.no_grad():
+            y = net(x, c)
+            ŷ = torch.cat(list(net.iter_chunked(x, c, size=37)), -1)
+        assert torch.allclose(y, ŷ, atol=1e-5)
+
+
+def test_cached_inverse():
+    from .nn.modules import InvConv2d, InvConv2dLU
+
+    x = torch.randn(2, 6, 4, 4)
+    for conv in [InvConv2d(6), InvConv2dLU(6)]:
+        with torch.no_grad():
+            y, log_det = conv(x)
+            weight = conv._weight() if hasattr(conv, "_weight") else conv.weight
+            assert torch.allclose(log_det, 16 * torch.slogdet(weight.squeeze())[1], atol=1e-4)
+            assert torch.allclose(conv.reverse(y), x, atol=1e-4)
+            # An in-place update of the parameters invalidates the cache
+            for p in conv.parameters():
+                p.mul_(1.5)
+            y, _ = conv(x)
+            assert torch.allclose(conv.reverse(y), x, atol=1e-4)
+
+
+def test_glow_sample():
+    from .nn.models.glow import Glow
+
+    model = Glow(4, 2, 3, groups=4, width=16)
+    x = torch.randn(2, 4, 16, 16)
+    model(x)
+    model.eval()
+    with torch.no_grad():
+        for block in model.blocks:
+            block.prior.conv.weight.normal_(0, 0.01)
+        out, z_list = x, []
+        for block in model.blocks:
+            out, _, _, z = block(out)
+            z_list.append(z)
+        assert [z.shape[1:] for z in z_list] == model.z_shapes(16, 16)
+        assert torch.allclose(model.reverse(z_list, reconstruct=True), x, atol=1e-5)
+    assert model.sample(3, 16, memory_budget=1, height=16).shape == (3, 4, 16, 16)
+    # Given latents are reversed in micro-batches just as at once
+    z = [torch.randn(3, *shape) for shape in model.z_shapes(16, 16)]
+    with torch.no_grad():
+        x = model.reverse(z)
+    assert torch.allclose(model.sample(3, 16, memory_budget=1, height=16, z=z), x, atol=1e-5)
+
+
+def test_grad_max():
+    from .utils import grad_max
+
+    a, b = torch.zeros(3, requires_grad=True), torch.zeros(2, requires_grad=True)
+    a.grad, b.grad = torch.tensor([1.0, -4.0, 2.0]), torch.tensor([0.5, 3.0])
+    assert grad_max([a, b]).item() == 4.0
+    b.grad[0] = float("nan")
+    assert not torch.isfinite(grad_max([a, b]))
+
+
+def test_checkpoint_writer(tmp_path):
+    from .io import CheckpointWriter, load_checkpoint, load_params
+
+    writer = CheckpointWriter(keep_last=1, keep_best=1)
+    x = torch.randn(8)
+    for it, score in enumerate([3.0, 1.0, 2.0, 4.0]):
+        writer.save({"x": x, "it": it}, str(tmp_path / f"{it}.pt"), score=score)
+    params = {"args": (), "kwargs": {"name": "a"}}
+    writer.save({"x": x, "params": params}, str(tmp_path / "4.pt"))
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["1.pt", "4.pt", "4.pt.params"]
+    assert torch.equal(torch.load(tmp_path / "1.pt")["x"], x)
+    assert load_params(str(tmp_path / "4.pt")) == params
+    assert load_params(str(tmp_path / "1.pt")) is None
+    assert load_checkpoint(str(tmp_path / "4.pt"))["params"] == params
+
+
+def test_load_model_cache(tmp_path):
+    import os
+    from torch import nn
+    from .io import CheckpointWriter, load_model
+
+    linear = nn.Linear(3, 2)
+    save_point = {
+        "model_state_dict": linear.state_dict(),
+        "params": {"__class__": nn.Linear, "args": (3, 2), "kwargs": {}},
+    }
+    # Older checkpoints hold the params in the same file
+    torch.save(save_point, tmp_path / "old.pt")
+    writer = CheckpointWriter(keep_last=None)
+    writer.save(save_point, str(tmp_path / "new.pt"))
+    writer.close()
+    for fp in [str(tmp_path / "old.pt"), str(tmp_path / "new.pt")]:
+        model = load_model(fp, "cpu")
+        assert torch.equal(model.weight, linear.weight) and not model.training
+        assert load_model(fp, "cpu") is model
+        assert load_model(fp, "cpu", cache=False) is not model
+        # A rewritten checkpoint is loaded again
+        mtime = os.path.getmtime(fp) + 10
+        os.utime(fp, (mtime, mtime))
+        assert load_model(fp, "cpu") is not model
+
+
+def test_checkpoint_index(tmp_path):
+    from .io import CheckpointIndex
+
+    index = CheckpointIndex(str(tmp_path))
+    index.add("a_Glow_1.pt", name="a", test=2.0)
+    index.add("b_Flowavenet_1.pt", name="b", test=1.0)
+    index.add("a_Glow_2.pt", name="a", test=3.0)
+    assert index.find().endswith("a_Glow_2.pt")
+    assert index.find(by="best").endswith("b_Flowavenet_1.pt")
+    assert index.find("*Glow*", by="best").endswith("a_Glow_1.pt")
+    index.remove("a_Glow_2.pt")
+    # A second reader sees the same
+    assert CheckpointIndex(str(tmp_path)).find(name="a").endswith("a_Glow_1.pt")
+    assert index.find("*Demixer*") is None
+
+
+def test_result_store(tmp_path):
+    import numpy as np
+    from .results import ResultStore
+
+    store = ResultStore(str(tmp_path / "results"))
+    for i in range(3):
+        store.append(logp=np.full((2, 4), i), levels=[0.1, 0.2])
+    store.append(logp=np.full((2, 4), 3))
+    assert store.keys() == ["levels", "logp"]
+    assert store["logp"].shape == (4, 2, 4) and store["levels"].shape == (3, 2)
+    store.compact("logp")
+    store.append(logp=np.full((2, 4), 4))
+    assert store["logp"][:, 0, 0].tolist() == [0, 1, 2, 3, 4]
+    assert "other" not in store and ResultStore(str(tmp_path / "none")).keys() == []
+
+
+def _count_locked(fp, n):
+    from .io import FileLock
+
+    for _ in range(n):
+        with FileLock(fp):
+            with open(fp) as file:
+                count = int(file.read())
+            with open(fp, "w") as file:
+                file.write(str(count + 1))
+
+
+def test_file_lock(tmp_path):
+    import multiprocessing
+    import socket
+    from os import path
+    from .io import FileLock
+
+    fp = str(tmp_path / "count")
+    with open(fp, "w") as file:
+        file.write("0")
+    processes = [multiprocessing.Process(target=_count_locked, args=(fp, 50)) for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    with open(fp) as file:
+        assert int(file.read()) == 200
+
+    with FileLock(fp):
+        try:
+            FileLock(fp, timeout=0.1).acquire()
+            assert False, "the lock is held"
+        except TimeoutError:
+            pass
+
+    # An exclusive lock file left behind by a dead process gets broken
+    lock = FileLock(str(tmp_path / "other"), timeout=1)
+    lock._exclusive = True
+    with open(lock.exclusive_path, "w") as file:
+        file.write(f"{socket.gethostname()} {2 ** 22 + 1}\n")
+    with lock:
+        assert lock._exclusive
+    # The empty file of the flock mode does not block the exclusive mode
+    with FileLock(fp):
+        pass
+    lock = FileLock(fp, timeout=1)
+    lock._exclusive = True
+    with lock:
+        assert path.exists(lock.path)
+    # Nor does an empty exclusive lock file, once it is old enough
+    lock = FileLock(fp, timeout=1, stale=0.0)
+    lock._exclusive = True
+    open(lock.exclusive_path, "w").close()
+    with lock:
+        assert lock._exclusive
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["count", "count.lock"]
+
+
+def _structure(batch):
+    if isinstance(batch, torch.Tensor):
+        return tuple(batch.shape)
+    return tuple(_structure(x) for x in batch)
+
+
+def test_toy_batch_augment(tmp_path):
+    import numpy as np
+    from .data.store import PackWriter
+    from .data.toy import ToyData, generate_toy_batch
+    from .train import prepare_batch
+
+    N, C = 4, 4
+    toy = generate_toy_batch(N, 3_000, C)
+    with PackWriter(str(tmp_path / "test.pack"), length=3_000, ns=C) as pack:
+        pack.write("sources", toy["sources"].astype(np.float32))
+        pack.write("mix", toy["mix"].astype(np.float32))
+
+    options = [
+        dict(source=True),
+        dict(mix=True, source=True),
+        dict(mix=True, mel_mix=True, source=True),
+        dict(source=True, mel_source=True),
+        dict(mel_source=True),
+        dict(mix=True, mel_mix=True, rand_amplitude=0.2),
+        dict(source=True, shuffle_indexed=True),
+    ]
+    for kwargs in options:
+        if not kwargs.get("shuffle_indexed"):
+            kwargs.update(rand_amplitude=0.2, noise=0.1)
+        batches = []
+        for batch_augment in [False, True]:
+            dataset = ToyData(str(tmp_path), "test", batch_augment=batch_augment, **kwargs)
+            batch = next(iter(dataset.loader(N, shuffle=False, num_workers=0)))
+            batches.append(prepare_batch(batch, "cpu", augment=dataset.augment))
+        item, batched = batches
+        assert _structure(item) == _structure(batched), kwargs
+        if kwargs.get("shuffle_indexed"):
+            for sources, idx in batches:
+                assert idx.shape == (N, C)
+                assert torch.equal(idx.sort(1).values, torch.arange(C).expand(N, C))
+                # Without amplitude and noise only the order is changed
+                raw = torch.tensor(toy["sources"], dtype=torch.float32)
+                assert torch.equal(sources, raw[torch.arange(N)[:, None], idx])
+
+
+def test_musdb_cached(tmp_path):
+    import pytest
+
+    try:
+        from .data.musdb import MusDB
+    except (ImportError, RuntimeError) as e:
+        pytest.skip(f"MusDB is not available: {e}")
+    from .data.store import PackWriter
+
+    (tmp_path / "musdb_cache").mkdir()
+    with PackWriter(str(tmp_path / "musdb_cache" / "test.pack"), n=2) as pack:
+        for idx in range(2):
+            pack.write(f"time/{idx:03}", torch.randn(4, 1_000).numpy())
+            pack.write(f"mel/{idx:03}", torch.randn(4, 265, 50).numpy())
+    data = MusDB(str(tmp_path / "musdb"), "test", cached=None)
+    assert [wav.shape for wav, _ in data] == [(4, 1_000)] * 2
+    samples = list(data.pre_save(n_per_song=3, length=200))
+    assert len(samples) == 6 and samples[0][0].shape == (4, 200)
+
+
+def test_langevin_trace():
+    from .langevin import LangevinSampler
+
+    class Gaussian(object):
+        def log_prob(self, x):
+            return -0.5 * (x ** 2).sum(1), torch.zeros_like(x[:, 0])
+
+    sampler = LangevinSampler(Gaussian(), σs=[0.1, 0.01], steps=3, η=1e-3, thin=1)
+    ŝ, log, trace = sampler.sample(torch.zeros(2, 1, 32), chains=3)
+    assert trace.shape == (6, 2, 3, 4, 32) and ŝ.shape == (2, 3, 4, 32)
+    assert torch.equal(trace[-1], ŝ)
+    assert all((a != b).any() for a, b in zip(trace[:-1], trace[1:]))
+
+
+def test_shard_writer_abort(tmp_path):
+    import numpy as np
+    from .data.store import ShardWriter, Shards
+
+    try:
+        with ShardWriter(str(tmp_path / "time"), shard_size=2) as writer:
+            for i in range(3):
+                writer.append(np.full(4, i, dtype=np.float32))
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    # Only the complete shard is left
+    assert [p.name for p in tmp_path.iterdir()] == ["time_000.pack"]
+    assert Shards([str(tmp_path / "time_000.pack")])[1].tolist() == [1.0] * 4
+
+
+def test_weigh_log():
+    from .train import split_batch, weigh_log
+    from .utils import _LossLogger
+
+    logger = _LossLogger()
+    logger.loss = 5.0
+    x = torch.arange(5.0)
+    start = {k: len(v) for k, v in logger.log.items()}
+    micro_batches = split_batch((x, x), 2)
+    for b, _ in micro_batches:
+        logger.loss, logger.per_channel = b.mean(), torch.stack([b.mean(), -b.mean()])
+    weigh_log(logger, start, [len(b) / len(x) for b, _ in micro_batches])
+    assert logger.log["loss"] == [5.0, x.mean().item()]
+    assert torch.allclose(logger.log["per_channel"][0], torch.tensor([2.0, -2.0]))
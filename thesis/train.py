@@ -1,46 +1,321 @@
 import os
+import queue
+import threading
 import time
 from collections import defaultdict
+from contextlib import nullcontext
 from datetime import datetime
 from statistics import mean
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import torch
 from colorama import Fore
+from torch import distributed as dist
 from torch import optim
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.utils import clip_grad_value_
 from torch.utils import data
 from torch import nn
 
-from functools import reduce
+from functools import partial, reduce
 from operator import add
-from .io import glob_remove
+from .bench import allocated
+from .io import CheckpointIndex, CheckpointWriter, to_cpu
 from .nn.models import BaseModel
-from .utils import max_grad, any_invalid_grad, _LossLogger
+from .utils import grad_max, _LossLogger
 
 LAST_LOG = defaultdict(float)
 LAST_LOG["start"] = True
 
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 _wandb = None
 
 
-def prepare_batch(batch, device):
+def prepare_batch(
+    batch, device, augment: Optional[nn.Module] = None, non_blocking: bool = False
+):
+    def to(x):
+        return x.to(device, non_blocking=non_blocking)
+
     if isinstance(batch, list):
         if isinstance(batch[0], list) or isinstance(batch[0], tuple):
             (x1, x2), y = (
-                (batch[0][0].to(device), batch[0][1].to(device)),
-                batch[1].to(device),
+                (to(batch[0][0]), to(batch[0][1])),
+                to(batch[1]),
             )
             batch = ((x1, x2), y)
         else:
-            x, y = batch[0].to(device), batch[1].to(device)
+            x, y = to(batch[0]), to(batch[1])
             batch = (x, y)
     else:
-        x = batch.to(device)
+        x = to(batch)
         batch = (x,)
+    if augment is not None:
+        batch = augment(*batch)
     return batch
 
 
+def split_batch(batch, size: int) -> List:
+    """
+    Splits a (nested) batch into micro-batches of the given size.
+    """
+    if isinstance(batch, torch.Tensor):
+        return list(batch.split(size))
+    parts = [split_batch(x, size) for x in batch]
+    return [type(batch)(part) for part in zip(*parts)]
+
+
+def weigh_log(logger: _LossLogger, start: Dict[str, int], weights: List[float]):
+    """
+    Replaces the values logged once per micro-batch since `start` (the
+    lengths of the logs before the batch) by their mean weighted with the
+    shares of the micro-batches, so one value is logged for the whole batch.
+    """
+    for k, values in logger.log.items():
+        new = values[start.get(k, 0) :]
+        if len(new) == len(weights) > 1:
+            values[start.get(k, 0) :] = [reduce(add, (w * v for w, v in zip(weights, new)))]
+
+
+def probe_micro_batch(
+    step: Callable[[Any], Any], batch, device: str, memory_budget: Optional[int]
+) -> int:
+    """
+    Finds the largest micro-batch size, a divisor of the batch size so that
+    all micro-batches are equal, for which a training step fits into the
+    memory budget. On the GPU the peak memory is measured and running out
+    of memory is caught. On the CPU the total allocated memory serves as a
+    (pessimistic) bound of the peak.
+
+    Args:
+        step: forward and backward pass of one micro-batch
+        batch: a full batch
+        device: the device to train on
+        memory_budget: bytes one step may use, None for the device limit
+
+    Returns:
+        the micro-batch size
+    """
+    device = torch.device(device)
+    N = next(_tensors(batch)).shape[0]
+    for size in [d for d in range(N, 0, -1) if N % d == 0]:
+        micro_batch = split_batch(batch, size)[0]
+        try:
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+                step(micro_batch)
+                used = torch.cuda.max_memory_allocated(device)
+            elif memory_budget is not None:
+                used = allocated(lambda: step(micro_batch), device)
+            else:
+                return size
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            used = None
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+        if used is not None and (memory_budget is None or used <= memory_budget):
+            return size
+    raise RuntimeError("Not even a single sample fits into the memory budget")
+
+
+def to_channels_last(batch):
+    """
+    Puts the image-like tensors of the batch in channels-last memory format.
+    """
+    return tuple(
+        x.contiguous(memory_format=torch.channels_last)
+        if isinstance(x, torch.Tensor) and x.dim() == 4
+        else x
+        for x in batch
+    )
+
+
+def _tensors(batch) -> Iterator[torch.Tensor]:
+    if isinstance(batch, torch.Tensor):
+        yield batch
+    else:
+        for x in batch:
+            yield from _tensors(x)
+
+
+class Prefetcher(object):
+    def __init__(
+        self,
+        loader: data.DataLoader,
+        device: str,
+        n: int = 2,
+        augment: Optional[nn.Module] = None,
+        cycle: bool = False,
+    ):
+        """
+        Loads and moves the batches to the device in a background thread, so
+        that the next batches are ready while the model computes. On CUDA the
+        copies are issued non-blocking on a side stream.
+
+        Args:
+            loader: the data loader
+            device: target device
+            n: number of batches in flight, 0 for loading synchronously
+            augment: batch augmentation, applied on the device
+            cycle: whether to restart the loader when it is exhausted
+        """
+        self.loader, self.device, self.n = loader, torch.device(device), n
+        self.augment, self.cycle = augment, cycle
+        # Time spent waiting for data in every step
+        self.waits = []
+
+    def _batches(self) -> Iterator:
+        epoch = 0
+        while True:
+            # A distributed sampler reshuffles by the epoch
+            if hasattr(self.loader.sampler, "set_epoch"):
+                self.loader.sampler.set_epoch(epoch)
+            yield from self.loader
+            if not self.cycle:
+                return
+            epoch += 1
+
+    @staticmethod
+    def _put(out: queue.Queue, stop: threading.Event, item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, out: queue.Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in self._batches():
+                if stream is None:
+                    item = (prepare_batch(batch, self.device), None)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = prepare_batch(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    item = (batch, event)
+                if not self._put(out, stop, item):
+                    return
+        except Exception as e:
+            self._put(out, stop, (e, None))
+            return
+        self._put(out, stop, (StopIteration(), None))
+
+    def __iter__(self):
+        if self.n == 0:
+            batches = iter(self._batches())
+            while True:
+                start = time.time()
+                try:
+                    batch = prepare_batch(next(batches), self.device)
+                except StopIteration:
+                    return
+                self.waits.append(time.time() - start)
+                yield self._augment(batch)
+
+        out, stop = queue.Queue(maxsize=self.n), threading.Event()
+        producer = threading.Thread(target=self._produce, args=(out, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                start = time.time()
+                batch, event = out.get()
+                if isinstance(batch, StopIteration):
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    for x in _tensors(batch):
+                        x.record_stream(torch.cuda.current_stream(self.device))
+                self.waits.append(time.time() - start)
+                yield self._augment(batch)
+        finally:
+            stop.set()
+
+    def _augment(self, batch):
+        if self.augment is None:
+            return batch
+        return self.augment(*batch)
+
+
+def distributed_env() -> Tuple[int, int, int]:
+    """
+    Rank, world size and local rank of this process, as set by torchrun or
+    the spawning in train.py, or by SLURM for the tasks of a job.
+    """
+    for keys in [
+        ("RANK", "WORLD_SIZE", "LOCAL_RANK"),
+        ("SLURM_PROCID", "SLURM_NTASKS", "SLURM_LOCALID"),
+    ]:
+        if all(key in os.environ for key in keys):
+            return tuple(int(os.environ[key]) for key in keys)
+    return 0, 1, 0
+
+
+def init_distributed(backend: str = "gloo"):
+    """
+    Joins the process group of the distributed training, if this process
+    is one of several. The address of rank 0 comes from MASTER_ADDR and
+    MASTER_PORT.
+    """
+    rank, world_size, _ = distributed_env()
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def _rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def _reduce_log(log: Dict) -> Dict:
+    """
+    Averages the logged values over all processes.
+    """
+    if not is_distributed() or not log:
+        return log
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    values = torch.tensor(list(log.values()), dtype=torch.float64, device=device)
+    dist.all_reduce(values)
+    values /= dist.get_world_size()
+    return dict(zip(log.keys(), values.tolist()))
+
+
+def _agree(flag: bool) -> bool:
+    """
+    Whether the flag is set in any process, so that all take the same path.
+    """
+    if not is_distributed():
+        return flag
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    flag = torch.tensor([flag], dtype=torch.uint8, device=device)
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+class _TestStep(nn.Module):
+    def __init__(self, model: BaseModel):
+        """
+        Runs the loss of the model as forward pass, which is where
+        DistributedDataParallel hooks in to sync the gradients.
+        """
+        super(_TestStep, self).__init__()
+        self.model = model
+
+    def forward(self, *batch):
+        return self.model.test(*batch)
+
+
 def print_log(LL, add_log: Dict, cat: str, step: Optional[int] = None):
     log = add_log.copy()
 
@@ -54,6 +329,10 @@ def print_log(LL, add_log: Dict, cat: str, step: Optional[int] = None):
                 log[f"{k}/{cat}"] = reduce(add, v) / len(v)
                 LL.log[k] = []
 
+    log = _reduce_log(log)
+    if _rank() != 0:
+        return log
+
     # Print to console
     _step = step if step is not None else "---"
     print(f"step {_step:>9} {Fore.YELLOW}[{cat}]", end=" ")
@@ -71,6 +350,7 @@ def print_log(LL, add_log: Dict, cat: str, step: Optional[int] = None):
 
     if _wandb is not None:
         _wandb.log(log, step=step)
+    return log
 
 
 def train(
@@ -82,32 +362,56 @@ def train(
     wandb: bool = False,
     keep_checkpoints: bool = False,
     keep_optim: bool = False,
+    keep_best: int = 0,
     base_lr: float = 1e-4,
     start_it: int = 0,
     optimizer_state_dict = None,
     scheduler_state_dict = None,
+    prefetch: int = 2,
+    precision: str = "fp32",
+    channels_last: bool = False,
+    micro_batch: Optional[int] = None,
+    memory_budget: Optional[int] = None,
 ):
     """
     Args:
         model: the module to train
-        gpu: list of GPUs to use (int indexes)
+        gpu: list of GPUs to use (int indexes). With several, every process
+            of the distributed training (see `init_distributed`) uses the
+            one of its local rank.
         train_loader: dataset loader for the training data
         test_loader: dataset loader for the test data
         iterations: number of iterations to train for
         wandb: Whether to log wandb
         keep_checkpoints: whether to keep all checkpoints not just the last one
         keep_optim: whether to also save the optimizer
+        keep_best: number of checkpoints with the lowest test loss to keep
+            besides the last one
         base_lr: the starting learing rate
         start_it
         optimizer_state_dict
         scheduler_state_dict
+        prefetch: number of batches to load ahead onto the device
+        precision: fp32, or bf16/fp16 for mixed precision with autocast
+        channels_last: whether to use the channels-last memory format for
+            the 2-d models
+        micro_batch: size of the micro-batches the gradients of a batch are
+            accumulated over, None for the whole batch, or for probing the
+            largest one that fits into the memory budget if that is given
+        memory_budget: bytes a training step may use, only used for probing
+            the micro-batch size
     """
     model_id = f"{datetime.today():%b%d-%H%M}_{type(model).__name__}_{model.name}"
     params = model.params
 
+    rank, _, local_rank = distributed_env()
+    distributed = is_distributed()
+    if gpu and len(gpu) > 1 and not distributed:
+        raise ValueError("Training on several GPUs needs one process per GPU")
+
     os.makedirs("./checkpoints/", exist_ok=True)
 
-    if wandb:
+    if wandb and rank == 0:
         global _wandb
         import wandb as __wandb
 
@@ -118,19 +422,36 @@ def train(
             project=__name__.split(".")[0],
         )
 
-    # Move model to device(s):
-    device = f"cuda:{gpu[0]}" if gpu else "cpu"
-    dataparallel = False
+    # Move model to device:
+    device = f"cuda:{gpu[local_rank if distributed else 0]}" if gpu else "cpu"
     if gpu:
-        dataparallel = len(gpu) > 1
-        if dataparallel:
-            modelclass = model.__class__
-            model = model.to(device)
-            model = nn.DataParallel(model, device_ids=gpu)
-            LL = _LossLogger()
-        else:
-            model = model.to(device)
-            LL = model.ℒ
+        torch.cuda.set_device(device)
+    model = model.to(device)
+    # Wrapped for the gradient sync after the act norms are initialized
+    ddp = None
+
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    # Mixed precision. bf16 has the range of fp32, only fp16 needs the loss
+    # scaled dynamically to keep the gradients from underflowing.
+    device_type = torch.device(device).type
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 is only supported on the GPU, use bf16 on the CPU")
+    autocast = partial(
+        torch.autocast,
+        device_type,
+        dtype=PRECISIONS[precision],
+        enabled=precision != "fp32",
+    )
+    scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+    # Batch-wise augmentations of the data sets, applied on the device
+    train_augment = getattr(train_loader.dataset, "augment", None)
+    test_augment = getattr(test_loader.dataset, "augment", None)
+    for augment in (train_augment, test_augment):
+        if augment is not None:
+            augment.to(device)
 
     # Setup optimizer and learning rate scheduler
     optimizer = optim.Adam(model.parameters(), eps=1e-8, lr=base_lr)
@@ -141,102 +462,180 @@ def train(
     if scheduler_state_dict is not None:
         scheduler.load_state_dict(scheduler_state_dict)
 
+    def loss(batch):
+        with autocast():
+            if ddp is not None and model.training:
+                return ddp(*batch)
+            return model.test(*batch)
+
+    if rank == 0:
+        checkpoints = CheckpointWriter(
+            keep_last=None if keep_checkpoints else 1,
+            keep_best=keep_best,
+            index=CheckpointIndex("./checkpoints"),
+        )
     losses, it_times = [], []
-    train_iterator = iter(train_loader)
+    train_batches = Prefetcher(
+        train_loader, device, n=prefetch, augment=train_augment, cycle=True
+    )
+    train_iterator = iter(train_batches)
     it_timer = time.time()
     model.train()
-    print(
-        f"\n{Fore.YELLOW}This is {Fore.GREEN}{model_id}{Fore.RESET}\n"
-        f"{Fore.YELLOW}{f'{Fore.GREEN} Start training {Fore.YELLOW}'.center(80, '-')}{Fore.RESET}"
-    )
-    for it in range(start_it, iterations):
-        it_start_time = time.time()
-        # Load next random batch
-        try:
-            batch = next(train_iterator)
-        except StopIteration:
-            train_iterator = iter(train_loader)
+    if rank == 0:
+        print(
+            f"\n{Fore.YELLOW}This is {Fore.GREEN}{model_id}{Fore.RESET}\n"
+            f"{Fore.YELLOW}{f'{Fore.GREEN} Start training {Fore.YELLOW}'.center(80, '-')}{Fore.RESET}"
+        )
+    # Waits for the checkpoint that is being written, also on errors and exits
+    try:
+        for it in range(start_it, iterations):
+            it_start_time = time.time()
+            # Load next random batch
             batch = next(train_iterator)
+            if channels_last:
+                batch = to_channels_last(batch)
 
-        if dataparallel:
-            ℒ = modelclass.test(model, *prepare_batch(batch, device), LL)
-        else:
-            ℒ = model.test(*prepare_batch(batch, device))
-        model.zero_grad()
+            if micro_batch is None and memory_budget is None:
+                micro_batch = next(_tensors(batch)).shape[0]
+            elif micro_batch is None:
+                # The probing steps would initialize the act norms, so their
+                # state is restored afterwards. Kept on the CPU, so that it
+                # is not measured.
+                state = to_cpu(model.state_dict())
+                initialized = {
+                    m: m.initialized for m in model.modules() if hasattr(m, "initialized")
+                }
+                micro_batch = probe_micro_batch(
+                    lambda b: loss(b).backward(), batch, device, memory_budget
+                )
+                model.load_state_dict(state)
+                for m, flag in initialized.items():
+                    m.initialized = flag
+                if rank == 0:
+                    print(f"{Fore.YELLOW}Micro-batch size is {Fore.GREEN}{micro_batch}{Fore.RESET}")
+                # The probing steps must not show up in the log
+                model.ℒ.log.clear()
 
-        if torch.isnan(ℒ) or torch.isinf(ℒ):
-            print(
-                Fore.RED + "NaN Loss ℒ.\n"
-                "Try Again. I'm gonna try to continue…" + Fore.RESET
-            )
-            exit()
-        else:
-            ℒ.backward()
-            clip_grad_value_(model.parameters(), 30)
-            if any_invalid_grad(model.parameters()):
-                print(
-                    Fore.RED + "There was a NaN or inf in one of the grads.\n"
-                    "Saving everything……" + Fore.RESET
+            if distributed and ddp is None:
+                # Every process initializes the act norms with its own data, the
+                # wrapping then broadcasts the parameters of rank 0 to all
+                with torch.no_grad():
+                    model.test(*split_batch(batch, micro_batch)[0])
+                model.ℒ.log.clear()
+                # The residual output of the last WaveNet layer goes unused
+                ddp = DistributedDataParallel(
+                    _TestStep(model),
+                    device_ids=[device] if gpu else None,
+                    find_unused_parameters=True,
                 )
-                save_point = {
-                    "model_state_dict": model.state_dict(),
-                    "params": params,
-                    "batch": batch,
-                    "optimizer_state_dict": optimizer.state_dict(),
-                    "it": it,
-                    "scheduler": scheduler.state_dict(),
-                }
-                torch.save(
-                    save_point, f"checkpoints/invalid_grad_{model_id}_{it:06}.pt"
+
+            # Accumulates the gradients over the micro-batches, weighted by their
+            # size the loss is the same as for the whole batch. So are the
+            # logged values.
+            model.zero_grad()
+            N, ℒ = next(_tensors(batch)).shape[0], 0
+            micro_batches = split_batch(batch, micro_batch)
+            weights = [next(_tensors(b)).shape[0] / N for b in micro_batches]
+            start = {k: len(v) for k, v in model.ℒ.log.items()}
+            for i, (b, w) in enumerate(zip(micro_batches, weights)):
+                # The gradients are synced once with the last micro-batch
+                last = i == len(micro_batches) - 1
+                with ddp.no_sync() if ddp is not None and not last else nullcontext():
+                    ℒ_micro = loss(b) * w
+                    scaler.scale(ℒ_micro).backward()
+                ℒ = ℒ + ℒ_micro.detach()
+            weigh_log(model.ℒ, start, weights)
+
+            if not torch.isfinite(ℒ):
+                print(
+                    Fore.RED + "NaN Loss ℒ.\n"
+                    "Try Again. I'm gonna try to continue…" + Fore.RESET
                 )
                 exit()
-            optimizer.step()
-            scheduler.step()
-
-        losses.append(ℒ.detach().item())
-        it_times.append(time.time() - it_start_time)
-
-        # LOG INFO (every 10 mini batches)
-        if it % 10 == 0 or it == iterations - 1:
-            log = {
-                "Loss/train": mean(losses),
-                "Time/train": mean(it_times),
-                "LR/train": optimizer.param_groups[0]["lr"],
-                "MaxGrad/train": max_grad(model.parameters()),
-            }
-            print_log(LL if dataparallel else model, log, "train", step=it)
-            losses, it_times = [], []
-
-        # TEST AND SAVE THE MODEL (every 30min)
-        if (time.time() - it_timer) > 1800 or it == iterations - 1:
-            if not keep_checkpoints:
-                glob_remove(f"checkpoints/{model_id}_*.pt")
-            save_point = {
-                "it": it,
-                "model_state_dict": model.state_dict(),
-                "params": params,
-            }
-            if keep_optim:
-                save_point.update(
-                    {"optimizer_state_dict": optimizer.state_dict(),
-                     "scheduler": scheduler.state_dict(),
-                     "test": ℒ}
-                )
-            torch.save(save_point, f"checkpoints/{model_id}_{it:06}.pt")
-            test_time, test_losses = time.time(), []
-            model.eval()
-            with torch.no_grad():
-                for batch in test_loader:
-                    if dataparallel:
-                        ℒ = modelclass.test(model,
-                                            *prepare_batch(batch, device), LL)
-                    else:
-                        ℒ = model.test(*prepare_batch(batch, device))
-                    test_losses.append(ℒ.detach().item())
-
-            log = {"Loss/test": mean(test_losses),
-                   "Time/test": time.time() - test_time}
-
-            print_log(LL if dataparallel else model, log, "test")
-            it_timer = time.time()
-            model.train()
+            else:
+                scaler.unscale_(optimizer)
+                clip_grad_value_(model.parameters(), 30)
+                # An overflow with a scaled loss only skips the step
+                ℒ_grad_max = grad_max(model.parameters())
+                if not scaler.is_enabled() and not torch.isfinite(ℒ_grad_max):
+                    print(
+                        Fore.RED + "There was a NaN or inf in one of the grads.\n"
+                        "Saving everything……" + Fore.RESET
+                    )
+                    save_point = {
+                        "model_state_dict": model.state_dict(),
+                        "params": params,
+                        "batch": batch,
+                        "optimizer_state_dict": optimizer.state_dict(),
+                        "it": it,
+                        "scheduler": scheduler.state_dict(),
+                    }
+                    # The gradients are synced, so all processes get here
+                    if rank == 0:
+                        torch.save(
+                            save_point, f"checkpoints/invalid_grad_{model_id}_{it:06}.pt"
+                        )
+                    exit()
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+
+            losses.append(ℒ.detach().item())
+            it_times.append(time.time() - it_start_time)
+
+            # LOG INFO (every 10 mini batches)
+            if it % 10 == 0 or it == iterations - 1:
+                log = {
+                    "Loss/train": mean(losses),
+                    "Time/train": mean(it_times),
+                    "Wait/train": mean(train_batches.waits),
+                    "LR/train": optimizer.param_groups[0]["lr"],
+                    "MaxGrad/train": ℒ_grad_max.item(),
+                }
+                print_log(model, log, "train", step=it)
+                losses, it_times = [], []
+                train_batches.waits.clear()
+
+            # TEST AND SAVE THE MODEL (every 30min), the processes agree on when
+            # along with the logging
+            due = it % 10 == 0 and _agree((time.time() - it_timer) > 1800)
+            if due or it == iterations - 1:
+                test_time, test_losses = time.time(), []
+                model.eval()
+                with torch.no_grad():
+                    for batch in Prefetcher(
+                        test_loader, device, n=prefetch, augment=test_augment
+                    ):
+                        if channels_last:
+                            batch = to_channels_last(batch)
+                        ℒ = loss(batch)
+                        test_losses.append(ℒ.detach().item())
+
+                log = {"Loss/test": mean(test_losses),
+                       "Time/test": time.time() - test_time}
+
+                log = print_log(model, log, "test")
+
+                # Written in the background, training only waits for the copy
+                if rank == 0:
+                    save_point = {
+                        "it": it,
+                        "model_state_dict": model.state_dict(),
+                        "params": params,
+                    }
+                    if keep_optim:
+                        save_point.update(
+                            {"optimizer_state_dict": optimizer.state_dict(),
+                             "scheduler": scheduler.state_dict(),
+                             "test": log["Loss/test"]}
+                        )
+                    checkpoints.save(
+                        save_point,
+                        f"checkpoints/{model_id}_{it:06}.pt",
+                        score=log["Loss/test"],
+                    )
+                it_timer = time.time()
+                model.train()
+    finally:
+        if rank == 0:
+            checkpoints.close()
@@ -74,16 +74,19 @@ def get_func_arguments():
     return arguments
 
 
+def grad_max(parameters) -> torch.Tensor:
+    """
+    Largest absolute value of all gradients in one reduction on the device,
+    without syncing. As NaN and inf propagate through the max, it also tells
+    whether any gradient is invalid.
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    return torch.stack([g.abs().max() for g in grads]).max()
+
+
 def any_invalid_grad(parameters):
-    parameters = list(filter(lambda x: x.grad is not None, parameters))
-    any_is_invalid = any(
-        torch.isnan(p.grad.data).any() or torch.isinf(p.grad.data).any()
-        for p in parameters
-    )
-    return any_is_invalid
+    return not torch.isfinite(grad_max(parameters)).item()
 
 
 def max_grad(parameters):
-    parameters = list(filter(lambda x: x.grad is not None, parameters))
-    max_value = max(p.grad.data.abs().max().item() for p in parameters)
-    return max_value
+    return grad_max(parameters).item()
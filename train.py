@@ -5,13 +5,14 @@ from functools import partial
 
 import torch
 from torch import autograd
+from torch import multiprocessing
 
-from thesis.data.toy import ToyData
+from thesis.data.toy import ToyData, ToyStream
 from thesis.data.musdb import MusDBSamples
-from thesis.io import load_model, get_newest_checkpoint
+from thesis.io import load_model, load_checkpoint, get_newest_checkpoint
 from thesis.nn.models.denoiser import Denoiser
 from thesis.setup import IS_HERMES, DEFAULT
-from thesis.train import train
+from thesis.train import train, distributed_env, init_distributed
 
 
 def train_baseline(args, rand_ampl=0.2, length=3_074):
@@ -25,9 +26,16 @@ def train_baseline(args, rand_ampl=0.2, length=3_074):
     if args.musdb:
         train_set = MusDBSamples(args.data, "train", space="time", length=args.length+1)
         test_set = MusDBSamples(args.data, "test", space="time", length=args.length+1)
+    elif args.procedural:
+        opt = dict(noise=args.noise or 0, rand_amplitude=rand_ampl, length=length + 1, source=True,
+                   batch_augment=args.batch_augment)
+        train_set = ToyStream(n=5_000, **opt)
+        test_set = ToyStream(n=1_500, seed=1, resample=False, **opt)
     else:
-        train_set = ToyData(args.data, "train", noise=args.noise, rand_amplitude=rand_ampl, length=length + 1, source=True)
-        test_set = ToyData(args.data, "test", noise=args.noise, rand_amplitude=rand_ampl, length=length + 1, source=True)
+        opt = dict(noise=args.noise, rand_amplitude=rand_ampl, length=length + 1, source=True,
+                   batch_augment=args.batch_augment)
+        train_set = ToyData(args.data, "train", **opt)
+        test_set = ToyData(args.data, "test", **opt)
     return model, train_set, test_set
 
 
@@ -70,10 +78,15 @@ def train_prior_time(args, rand_ampl=0.2, classified=False):
         test_set = MusDBSamples(args.data, "test", space="time", length=args.length)
     else:
         opt = dict(
-            noise=args.noise, rand_amplitude=rand_ampl, length=args.length, source=source, shuffle_indexed=classified
+            noise=args.noise, rand_amplitude=rand_ampl, length=args.length, source=source, shuffle_indexed=classified,
+            batch_augment=args.batch_augment
         )
-        train_set = ToyData(args.data, "train", **opt)
-        test_set = ToyData(args.data, "test", **opt)
+        if args.procedural:
+            train_set = ToyStream(n=5_000, **opt)
+            test_set = ToyStream(n=1_500, seed=1, resample=False, **opt)
+        else:
+            train_set = ToyData(args.data, "train", **opt)
+            test_set = ToyData(args.data, "test", **opt)
     return model, train_set, test_set
 
 
@@ -103,7 +116,8 @@ def train_prior_mel(args, noise=0.0):
         test_set = MusDBSamples(args.data, "test", space="mel", length=args.length)
     else:
         opt = dict(
-            noise=noise, length=args.length, mel_source=source
+            noise=noise, length=args.length, mel_source=source, batch_augment=args.batch_augment,
+            mel_cache=args.mel_cache
         )
         train_set = ToyData(args.data, "train", **opt)
         test_set = ToyData(args.data, "test", **opt)
@@ -140,8 +154,12 @@ def train_denoiser(args, modelclass):
 
 def main(args):
     if IS_HERMES:
-        args.batch_size = 2
+        # Only batches of 2 fit on hermes, larger ones are accumulated
+        args.batch_size = args.batch_size or 2
+        if args.micro_batch is None:
+            args.micro_batch = 2
 
+    init_distributed(args.backend or ("nccl" if args.gpu else "gloo"))
     DEFAULT.musdb = args.musdb
     if args.data is None:
         args.data = DEFAULT.data
@@ -151,7 +169,7 @@ def main(args):
 
     if args.weights is not None:
         device = f"cuda:{args.gpu[0]}" if args.gpu else "cpu"
-        spt = torch.load(get_newest_checkpoint(args.weights), map_location=torch.device(device))
+        spt = load_checkpoint(get_newest_checkpoint(args.weights), device, optim=True)
         state = model.state_dict()
         state.update(spt['model_state_dict'])
         model.load_state_dict(state)
@@ -163,8 +181,8 @@ def main(args):
                 module.initialized = True
 
     print(f"pid is: {os.getpid()}")
-    train_loader = train_set.loader(args.batch_size)
-    test_loader = test_set.loader(args.batch_size)
+    train_loader = train_set.loader(args.batch_size, num_workers=args.workers)
+    test_loader = test_set.loader(args.batch_size, num_workers=args.workers)
 
     if args.debug:
         torch.manual_seed(0)
@@ -180,13 +198,24 @@ def main(args):
             iterations=args.iterations,
             wandb=args.wandb,
             keep_optim=True,
+            keep_best=args.keep_best,
             base_lr=args.base_lr,
             start_it=start_it,
             optimizer_state_dict=optimizer_state_dict,
             scheduler_state_dict=scheduler_state_dict,
+            prefetch=args.prefetch,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            micro_batch=args.micro_batch,
+            memory_budget=args.memory_budget,
         )
 
 
+def spawn_main(rank: int, nproc: int, args):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(nproc), LOCAL_RANK=str(rank))
+    main(args)
+
+
 EXPERIMENTS = {
     "prior_time": train_prior_time,
     "prior_mel": train_prior_mel,
@@ -215,4 +244,32 @@ if __name__ == "__main__":
     parser.add_argument("-lr", type=float, default=1e-4, dest='base_lr')
     parser.add_argument("--weights", type=str)
     parser.add_argument("-noise", type=float)
-    main(parser.parse_args())
+    parser.add_argument("-procedural", action="store_true", help="Synthesizes the toy data on the fly.")
+    parser.add_argument("-batch_augment", action="store_true", help="Augments the toy data batch-wise on the device.")
+    parser.add_argument("--mel_cache", type=int, default=0, help="Byte budget for caching mel-spectrograms.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of data loader workers.")
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of batches to load ahead.")
+    parser.add_argument("--precision", choices=["fp32", "bf16", "fp16"], default="fp32",
+                        help="Mixed precision with autocast, fp16 with loss scaling.")
+    parser.add_argument("-channels_last", action="store_true", help="Channels-last memory format for the mel models.")
+    parser.add_argument("--micro_batch", type=int, default=None,
+                        help="Accumulates the gradients over micro-batches of this size, defaults to the batch size.")
+    parser.add_argument("--memory_budget", type=int, default=None,
+                        help="Byte budget of a training step, probes the micro-batch size if given.")
+    parser.add_argument("--keep_best", type=int, default=0,
+                        help="Number of checkpoints with the lowest test loss to keep.")
+    parser.add_argument("--nproc", type=int, default=None,
+                        help="Number of training processes, defaults to one per GPU.")
+    parser.add_argument("--backend", choices=["gloo", "nccl"], default=None,
+                        help="Backend of the distributed training.")
+    args = parser.parse_args()
+
+    nproc = args.nproc or (len(args.gpu) if args.gpu else 1)
+    if nproc > 1 and distributed_env()[1] == 1:
+        # Not started as one of several tasks (torchrun, srun), so the
+        # processes are spawned here
+        os.environ.setdefault("MASTER_ADDR", "localhost")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        multiprocessing.spawn(spawn_main, args=(nproc, args), nprocs=nproc)
+    else:
+        main(args)